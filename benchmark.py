@@ -0,0 +1,255 @@
+##############################################################################
+# author: Lyron Winderbaum (lyron.winderbaum@student.adelaide.edu.au)        #
+#                                                                            #
+##############################################################################
+# Benchmarks for mascotpy. Generates synthetic MASCOT .dat files at a range  #
+# of sizes and times dat2tex and dat2csv, with and without the peptide       #
+# summary, on each. By default the pure-python datparser backend stands in   #
+# for msparser, so this runs on any machine. Each run happens in its own     #
+# process so its peak memory can be measured, and results are written as     #
+# JSON to track over releases, e.g.                                          #
+#                                                                            #
+#   python benchmark.py --sizes small,medium -o bench.json                  #
+#   python benchmark.py --generate big.dat --queries 200000                  #
+##############################################################################
+
+import os, sys, optparse, random, json, time, shutil, tempfile
+import multiprocessing
+import mascotpy
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+WORDS = ("protein", "kinase", "receptor", "binding", "subunit", "alpha", "beta",
+         "precursor", "domain", "containing", "factor", "homolog", "putative",
+         "mitochondrial", "ribosomal", "transport", "regulatory", "isoform")
+VAR_MODS = ("Oxidation (M)", "Phospho (ST)", "Deamidated (NQ)", "Acetyl (Protein N-term)")
+BOUNDARY = "gc0p4Jq0M2Yt08jU534c0p"
+
+# Named benchmark sizes: (queries, proteins, peptides per protein,
+# description length, fraction of peptides with variable modifications).
+SIZES = {"small":  (2000,    200,  5,  60, 0.2),
+         "medium": (20000,   2000, 8,  80, 0.2),
+         "large":  (200000, 10000, 12, 120, 0.3)}
+
+
+def _section(out, name):
+    out.write("--%s\nContent-Type: application/x-Mascot; name=\"%s\"\n\n" % (BOUNDARY, name))
+
+
+# Writes a synthetic (but well-formed) MASCOT MS/MS result file. Every query
+# has a rank 1 match to a peptide of one of the proteins (some peptides are
+# shared between two proteins) and a lower scoring rank 2 match. With decoys,
+# each query also gets a (generally lower scoring) decoy search match.
+def writeSyntheticDat(path,queries=2000,proteins=200,pepsPerProtein=5,descLength=60,
+                      varModFraction=0.2,peaks=20,seed=0,decoys=False):
+    rng = random.Random(seed)
+    accessions = ["SYN%06d" % i for i in range(1, proteins+1)]
+
+    # Peptides of each protein: (sequence, start, end).
+    peptides = []
+    for acc in accessions:
+        pos = 1
+        for _ in range(pepsPerProtein):
+            length = rng.randint(6, 24)
+            seq = "".join(rng.choice(AMINO_ACIDS) for _ in range(length)) + rng.choice("KR")
+            peptides.append( (seq, [(acc, pos, pos+length)]) )
+            pos += length + rng.randint(1, 30)
+    # Share some peptides with a second protein, to exercise grouping.
+    for seq, prots in rng.sample(peptides, len(peptides)//10):
+        other = rng.choice(accessions)
+        if other != prots[0][0]:
+            prots.append( (other, prots[0][1], prots[0][2]) )
+
+    with open(path, "w") as out:
+        out.write("MIME-Version: 1.0 (Generated by Mascot version 1.0)\n"
+                  "Content-Type: multipart/mixed; boundary=%s\n\n" % BOUNDARY)
+
+        _section(out, "parameters")
+        out.write("COM=Synthetic benchmark search (%d queries)\nDB=SwissProt\n"
+                  "TAXONOMY=. . . . . Homo sapiens (human)\nCLE=Trypsin\nPFA=1\n"
+                  "MODS=Carbamidomethyl (C)\nIT_MODS=%s\nTOL=10\nTOLU=ppm\nITOL=0.5\n"
+                  "ITOLU=Da\nSEARCH=MIS\nDECOY=%d\n" % (queries, ",".join(VAR_MODS), int(decoys)))
+
+        _section(out, "masses")
+        out.write("C_term=17.002740\nN_term=1.007825\n")
+        for i, mod in enumerate(VAR_MODS, 1):
+            out.write("delta%d=%.6f,%s\n" % (i, rng.uniform(0.5, 100), mod))
+
+        _section(out, "header")
+        out.write("sequences=550000\nresidues=196000000\nqueries=%d\n" % queries)
+
+        _section(out, "summary")
+        for q in range(1, queries+1):
+            out.write("qmass%d=%.6f\nqexp%d=%.6f,2+\nqmatch%d=%d\nqplughole%d=%.6f\n"
+                      % (q, rng.uniform(600, 3000), q, rng.uniform(300, 1500),
+                         q, rng.randint(50, 5000), q, rng.uniform(0, 30)))
+
+        _section(out, "peptides")
+        for q in range(1, queries+1):
+            for p, scale in ((1, 1.0), (2, 0.4)):
+                seq, prots = peptides[(q*p - 1) % len(peptides)]
+                mods = "0"*(len(seq)+2)
+                if rng.random() < varModFraction:
+                    i = rng.randint(1, len(seq))
+                    mods = mods[:i] + str(rng.randint(1, len(VAR_MODS))) + mods[i+1:]
+                out.write("q%d_p%d=%d,%.6f,%.6f,%d,%s,%d,%s,%.2f,0001002000000000000,0,0;%s\n"
+                          % (q, p, rng.randint(0, 1), rng.uniform(600, 3000), rng.uniform(-0.02, 0.02),
+                             rng.randint(3, 20), seq, rng.randint(10, 60), mods,
+                             scale*rng.uniform(10, 90),
+                             ",".join('"%s":0:%d:%d:1' % prot for prot in prots)))
+                out.write("q%d_p%d_terms=%s\n" % (q, p, ":".join("K,A" for prot in prots)))
+
+        if decoys:
+            _section(out, "decoy_peptides")
+            for q in range(1, queries+1):
+                seq = "".join(rng.choice(AMINO_ACIDS) for _ in range(rng.randint(6, 24))) + rng.choice("KR")
+                out.write("q%d_p1=0,%.6f,%.6f,%d,%s,%d,%s,%.2f,0001002000000000000,0,0;\"DECOY%06d\":0:1:%d:1\n"
+                          % (q, rng.uniform(600, 3000), rng.uniform(-0.02, 0.02), rng.randint(3, 20), seq,
+                             rng.randint(10, 60), "0"*(len(seq)+2), rng.uniform(0, 60),
+                             rng.randint(1, proteins), len(seq)))
+
+        _section(out, "proteins")
+        for acc in accessions:
+            words = []
+            while len(" ".join(words)) < descLength:
+                words.append(rng.choice(WORDS))
+            out.write("\"%s\"=%.2f,\"%s\"\n" % (acc, rng.uniform(5000, 250000), " ".join(words)[:descLength].strip()))
+
+        for q in range(1, queries+1):
+            _section(out, "query%d" % q)
+            out.write("title=Synthetic%%20spectrum%%20%d\ncharge=2+\nIons1=%s\n"
+                      % (q, ",".join("%.4f:%.1f" % (rng.uniform(100, 2000), rng.uniform(1, 1e5))
+                                     for _ in range(peaks))))
+        out.write("--%s--\n" % BOUNDARY)
+
+
+# Runs one conversion in a fresh process, so the process's peak RSS belongs
+# to that conversion alone. A conversion that raises is reported with the
+# exception as its status.
+def _timeRun(queue, function, inputfile, outputfile, includePepSummary, backend):
+    import resource
+    start = time.time()
+    try:
+        status = getattr(mascotpy, function)(inputfile, outputfile, 0, 0.05, includePepSummary, backend)
+    except Exception as e:
+        status = "%s: %s" % (type(e).__name__, e)
+    seconds = time.time() - start
+    # ru_maxrss is in kB on linux (bytes on OS X).
+    queue.put( (status, seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) )
+
+
+# (status, seconds, peak RSS) of one conversion, status is falsy if it
+# succeeded. If the child process dies without reporting back (e.g. a crash
+# in msparser) its exit code is the status.
+def timeConversion(function,inputfile,outputfile,includePepSummary=False,backend="native"):
+    import Queue
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_timeRun,
+                                   args=(queue, function, inputfile, outputfile, includePepSummary, backend))
+    start = time.time()
+    proc.start()
+    while True:
+        try:
+            status, seconds, peak_rss = queue.get(timeout=1)
+            break
+        except Queue.Empty:
+            if not proc.is_alive() and queue.empty():
+                status, seconds, peak_rss = "exit code %s" % proc.exitcode, time.time() - start, 0
+                break
+    proc.join()
+    return status, seconds, peak_rss
+
+
+# Benchmarks each named size, returns a list of result records.
+def runBenchmarks(sizes=("small", "medium"),backend="native",workdir=None,repeat=1):
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix="mascotpy_bench_")
+    records = []
+    try:
+        for size in sizes:
+            queries, proteins, peps, descLength, varModFraction = SIZES[size]
+            inputfile = os.path.join(workdir, "synthetic_%s.dat" % size)
+            if not os.path.isfile(inputfile):
+                writeSyntheticDat(inputfile, queries, proteins, peps, descLength, varModFraction)
+            nbytes = os.path.getsize(inputfile)
+            for function, ext in (("dat2tex", ".tex"), ("dat2csv", ".csv")):
+                for includePepSummary in (False, True):
+                    outputfile = os.path.join(workdir, "out_%s%s" % (size, ext))
+                    for _ in range(repeat):
+                        status, seconds, peak_rss = timeConversion(
+                            function, inputfile, outputfile, includePepSummary, backend)
+                        record = {"size":            size,
+                                  "queries":         queries,
+                                  "proteins":        proteins,
+                                  "peps_per_protein": peps,
+                                  "file_bytes":      nbytes,
+                                  "function":        function,
+                                  "peptide_summary": includePepSummary,
+                                  "backend":         backend,
+                                  "ok":              not status,
+                                  "seconds":         seconds,
+                                  "mb_per_s":        nbytes / 1e6 / max(seconds, 1e-9),
+                                  "queries_per_s":   queries / max(seconds, 1e-9),
+                                  "peak_rss_kb":     peak_rss,
+                                  "output_bytes":    os.path.getsize(outputfile) if not status else 0}
+                        records.append(record)
+                        print >>sys.stderr, "%-6s %s %-5s %8.3fs %8.1f MB/s %8d kB" % (
+                            size, function, "-s" if includePepSummary else "", seconds,
+                            record["mb_per_s"], peak_rss)
+                        if status:
+                            record["error"] = str(status)
+                            print >>sys.stderr, "       FAILED:", status
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir)
+    return records
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option('--sizes',dest='sizes',default="small,medium",
+                      help="Comma separated sizes to benchmark: %s" % ", ".join(sorted(SIZES)))
+    parser.add_option('-b','--backend',dest='b',default="native",type="choice",
+                      choices=mascotpy.BACKENDS,help="Results backend to benchmark (default native)")
+    parser.add_option('-r','--repeat',dest='r',default=1,type="int",help="Runs per measurement")
+    parser.add_option('-w','--workdir',dest='w',default=None,
+                      help="Directory to keep (and reuse) the generated .dat files in")
+    parser.add_option('-o','--outputfile',dest='o',default=None,
+                      help="File to write JSON results to (default stdout)")
+    parser.add_option('--generate',dest='generate',default=None,
+                      help="Only write a synthetic .dat file to this filename")
+    parser.add_option('--queries',dest='queries',default=2000,type="int")
+    parser.add_option('--proteins',dest='proteins',default=200,type="int")
+    parser.add_option('--peptides-per-protein',dest='peps',default=5,type="int")
+    parser.add_option('--description-length',dest='desc',default=60,type="int")
+    parser.add_option('--var-mod-fraction',dest='mods',default=0.2,type="float")
+    parser.add_option('--seed',dest='seed',default=0,type="int")
+    parser.add_option('--decoys',dest='decoys',default=False,action="store_true",
+                      help="Include a decoy search in the generated file")
+    opts, args = parser.parse_args(argv)
+
+    if opts.generate is not None:
+        writeSyntheticDat(opts.generate, opts.queries, opts.proteins, opts.peps,
+                          opts.desc, opts.mods, seed=opts.seed, decoys=opts.decoys)
+        return 0
+
+    sizes = [size.strip() for size in opts.sizes.split(",") if size.strip()]
+    for size in sizes:
+        if size not in SIZES:
+            parser.error("unknown size '%s'" % size)
+    if opts.w is not None and not os.path.isdir(opts.w):
+        os.makedirs(opts.w)
+    records = runBenchmarks(sizes, opts.b, opts.w, opts.r)
+    report = json.dumps({"python": sys.version.split()[0],
+                         "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                         "results": records}, indent=1, sort_keys=True)
+    if opts.o is None:
+        print report
+    else:
+        with open(opts.o, "w") as f:
+            f.write(report + "\n")
+    return 0 if all(record["ok"] for record in records) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,612 @@
+##############################################################################
+# author: Lyron Winderbaum (lyron.winderbaum@student.adelaide.edu.au)        #
+#                                                                            #
+##############################################################################
+# A pure-python reader for MASCOT search result (.dat) files, exposing the   #
+# (small) part of the msparser API that mascotpy uses. This allows mascotpy  #
+# to run on systems without an msparser build, and avoids loading the whole  #
+# result file up front: the file is memory-mapped, an index of section byte  #
+# offsets is built on open, and each section is only parsed when asked for.  #
+#                                                                            #
+# Protein grouping is an approximation of what msparser does: hits are       #
+# built from rank 1 peptide matches, proteins matching the same (or a subset #
+# of the) peptides of a higher scoring hit are folded into that hit, and     #
+# emPAI is not available (returned as -1, as msparser does when it cannot    #
+# calculate it).                                                             #
+##############################################################################
+
+import array, math, mmap, os, re
+
+
+class ms_mascotresults(object):
+    # Flags accepted by ms_peptidesummary. Only MSRES_GROUP_PROTEINS and
+    # MSRES_DECOY (summarise the decoy search) change the behaviour of this
+    # reader, the rest are accepted for compatibility.
+    MSRES_NOFLAG          = 0x0000
+    MSRES_GROUP_PROTEINS  = 0x0001
+    MSRES_SHOW_SUBSETS    = 0x0002
+    MSRES_DUPE_REMOVE_A   = 0x0010
+    MSRES_DUPE_REMOVE_B   = 0x0020
+    MSRES_DUPE_REMOVE_C   = 0x0040
+    MSRES_DUPE_REMOVE_D   = 0x0080
+    MSRES_DUPE_REMOVE_E   = 0x0100
+    MSRES_DUPE_REMOVE_F   = 0x0200
+    MSRES_DECOY           = 0x1000
+
+    # Threshold types for getPeptideThreshold.
+    TT_HOMOLOGY = 0
+    TT_IDENTITY = 1
+
+
+# Section names look like `Content-Type: application/x-Mascot; name="xxx"'.
+_SECTION_NAME = re.compile(r'name="([^"]*)"')
+_BOUNDARY = re.compile(r'boundary=(\S+)')
+# Rank 1 lines of a peptides section, q<query>_p1=<value>.
+_TOP_PEPTIDE = re.compile(r'^q(\d+)_p1=([^\r\n]*)', re.M)
+
+
+# Splits the key=value lines of a section into a dictionary.
+def parseSection(text):
+    section = {}
+    for line in text.splitlines():
+        key, sep, value = line.rstrip("\r").partition("=")
+        if sep:
+            section[key] = value
+    return section
+
+
+class ms_searchparams(object):
+
+    # Accessors that msparser returns as numbers rather than strings.
+    _INTS   = ("PFA",)
+    _FLOATS = ("TOL", "ITOL")
+
+    def __init__(self, section):
+        self._section = section
+
+    # Provides getCOM(), getDB(), getTOL() etc. for every parameter.
+    def __getattr__(self, name):
+        if not name.startswith("get"):
+            raise AttributeError(name)
+        key   = name[3:]
+        value = self._section.get(key, "")
+        if key in self._INTS:
+            value = int(value or 0)
+        elif key in self._FLOATS:
+            value = float(value or 0)
+        return lambda: value
+
+
+class ms_mascotresfile(object):
+
+    def __init__(self, filename):
+        self.filename  = filename
+        self.sections  = {}
+        self._cache    = {}
+        self._top      = {}
+        self._lines    = {}
+        self._error    = ""
+        self._mm       = None
+        try:
+            with open(filename, "rb") as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as e:
+            self._error = "Cannot open file '%s': %s" % (filename, e)
+            return
+        self._index()
+
+    # Records the (start, end) byte offsets of the content of every section.
+    def _index(self):
+        mm = self._mm
+        match = _BOUNDARY.search(mm[:4096])
+        if match is None:
+            self._error = "No MIME boundary found, not a MASCOT results file"
+            return
+        delim = "--" + match.group(1).strip('"')
+        pos = mm.find(delim)
+        while pos != -1:
+            nxt = mm.find(delim, pos + len(delim))
+            end = nxt if nxt != -1 else len(mm)
+            # Section headers run up to the first blank line.
+            line = mm.find("\n", pos) + 1
+            name = None
+            while 0 < line < end:
+                line_end = mm.find("\n", line)
+                if line_end == -1 or line_end >= end:
+                    break
+                header = mm[line:line_end].rstrip("\r")
+                line = line_end + 1
+                if not header:
+                    break
+                if name is None:
+                    name = _SECTION_NAME.search(header)
+            if name is not None:
+                self.sections[name.group(1)] = (line, end)
+            pos = nxt
+
+    def hasSection(self, name):
+        return name in self.sections
+
+    # Raw text of a section (empty if it is not in the file).
+    def sectionText(self, name):
+        if name not in self.sections:
+            return ""
+        start, end = self.sections[name]
+        return self._mm[start:end]
+
+    # Parsed key=value dictionary of a section, parsed on first use.
+    def section(self, name):
+        if name not in self._cache:
+            self._cache[name] = parseSection(self.sectionText(name))
+        return self._cache[name]
+
+    # Rank 1 peptide matches of the peptides (or decoy_peptides) section,
+    # {(query, 1): ms_peptide}, read on first use with a scan of the section
+    # text for q<query>_p1 lines (the rest of the section is left unparsed)
+    # and shared by every summary built from this file. The offset of each
+    # query's rank 1 line is kept for peptideLine.
+    def topPeptides(self, name="peptides"):
+        if name not in self._top:
+            top = self._top[name] = {}
+            lines = self._lines[name] = array.array("d")
+            if name in self.sections:
+                start, end = self.sections[name]
+                for match in _TOP_PEPTIDE.finditer(self._mm, start, end):
+                    q = int(match.group(1))
+                    if q >= len(lines):
+                        lines.extend([-1]*(q + 1 - len(lines)))
+                    lines[q] = match.start()
+                    if match.group(2) != "-1":
+                        top[(q, 1)] = ms_peptide(q, 1, match.group(2))
+        return self._top[name]
+
+    # The value of line q<q>_p<p> of the peptides (or decoy_peptides)
+    # section, or None if there is none. A query's lines follow its rank 1
+    # line, so only the text up to the next query's is searched.
+    def peptideLine(self, name, q, p):
+        self.topPeptides(name)
+        lines = self._lines[name]
+        if not 0 <= q < len(lines) or lines[q] < 0:
+            return None
+        start, end = int(lines[q]), self.sections[name][1]
+        if q + 1 < len(lines) and lines[q+1] > start:
+            end = int(lines[q+1])
+        match = re.compile(r'^q%d_p%d=([^\r\n]*)' % (q, p), re.M).search(self._mm, start, end)
+        return match.group(1) if match else None
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def isValid(self):
+        return not self._error
+
+    def getLastErrorString(self):
+        return self._error
+
+    def isMSMS(self):
+        return self.section("parameters").get("SEARCH", "MIS") == "MIS"
+
+    def params(self):
+        return ms_searchparams(self.section("parameters"))
+
+    def getNumQueries(self):
+        return int(self.section("header").get("queries", 0) or 0)
+
+
+class ms_peptide(object):
+
+    __slots__ = ("query", "rank", "missed", "mr", "delta", "numIonsMatched",
+                 "peptideStr", "varMods", "ionsScore", "proteins")
+
+    def __init__(self, query, rank, value):
+        self.query = query
+        self.rank  = rank
+        fields, _, prots = value.partition(";")
+        fields = fields.split(",")
+        self.missed         = int(fields[0])
+        self.mr             = float(fields[1])
+        self.delta          = float(fields[2])
+        self.numIonsMatched = int(fields[3])
+        self.peptideStr     = fields[4]
+        self.varMods        = fields[6]
+        self.ionsScore      = float(fields[7])
+        # (accession, start, end) of every protein the peptide maps to.
+        self.proteins = []
+        for prot in re.findall(r'"([^"]*)":\d+:(\d+):(\d+):\d+', prots):
+            self.proteins.append((prot[0], int(prot[1]), int(prot[2])))
+
+    def getQuery(self):
+        return self.query
+
+    def getRank(self):
+        return self.rank
+
+    def getPeptideStr(self):
+        return self.peptideStr
+
+    def getIonsScore(self):
+        return self.ionsScore
+
+    def getMissedCleavages(self):
+        return self.missed
+
+    def getMrCalc(self):
+        return self.mr
+
+    def getDelta(self):
+        return self.delta
+
+    def getVarModsStr(self):
+        return self.varMods
+
+
+class ms_protein(object):
+
+    def __init__(self, accession, peptides):
+        self.accession = accession
+        # [(query, rank, score, start, end)] ordered by query.
+        self.peptides  = peptides
+        self.score     = self._score()
+
+    # Standard MASCOT scoring: the sum of the best ions score for each
+    # distinct query.
+    def _score(self):
+        best = {}
+        for q, p, score, start, end in self.peptides:
+            if score > best.get(q, 0):
+                best[q] = score
+        return sum(best.values())
+
+    def getAccession(self):
+        return self.accession
+
+    def getNumPeptides(self):
+        return len(self.peptides)
+
+    def getPeptideQuery(self, i):
+        if 1 <= i <= len(self.peptides):
+            return self.peptides[i-1][0]
+        return -1
+
+    def getPeptideP(self, i):
+        if 1 <= i <= len(self.peptides):
+            return self.peptides[i-1][1]
+        return -1
+
+    def getScore(self):
+        return self.score
+
+    # Number of residues covered by at least one peptide.
+    def getCoverage(self):
+        covered = 0
+        last = 0
+        for start, end in sorted((pep[3], pep[4]) for pep in self.peptides):
+            if end <= last:
+                continue
+            covered += end - max(start, last + 1) + 1
+            last = end
+        return covered
+
+
+class ms_peptidesummary(ms_mascotresults):
+
+    def __init__(self, resfile, flags=0, minProbability=0.05, maxHitsToReport=50,
+                 unigeneIndexFile="", minIonsScore=0, minPepLenInPepSummary=0):
+        self.resfile      = resfile
+        self.flags        = flags
+        self.minIonsScore = minIonsScore
+        self.minPepLen    = minPepLenInPepSummary
+        self._section     = "decoy_peptides" if flags & self.MSRES_DECOY else "peptides"
+        self._peptides    = dict(resfile.topPeptides(self._section))
+        self._proteins    = None
+        self._mods        = None
+        self.hits = self._buildHits(minProbability, maxHitsToReport)
+
+    def _buildHits(self, minProbability, maxHits):
+        proteins = {}
+        for (q, p), pep in self.resfile.topPeptides(self._section).iteritems():
+            if pep.ionsScore < self.minIonsScore or len(pep.peptideStr) < self.minPepLen:
+                continue
+            for accession, start, end in pep.proteins:
+                proteins.setdefault(accession, []).append((q, p, pep.ionsScore, start, end))
+
+        hits = [ms_protein(acc, sorted(peps)) for acc, peps in proteins.iteritems()]
+        hits.sort(key=lambda hit: (-hit.score, hit.accession))
+
+        # Protein probability is 10^(-score/10), hits above minProbability
+        # are not reported.
+        if 0 < minProbability < 1:
+            minScore = -10*math.log10(minProbability)
+            hits = [hit for hit in hits if hit.score >= minScore]
+
+        if self.flags & self.MSRES_GROUP_PROTEINS:
+            leaders = []
+            byPeptide = {}
+            for hit in hits:
+                keys = set((pep[0], pep[1]) for pep in hit.peptides)
+                first = min(keys)
+                if any(keys <= leader for leader in byPeptide.get(first, ())):
+                    continue
+                leaders.append(hit)
+                for key in keys:
+                    byPeptide.setdefault(key, []).append(keys)
+            hits = leaders
+
+        if maxHits > 0:
+            hits = hits[:maxHits]
+        return hits
+
+    def getNumberOfHits(self):
+        return len(self.hits)
+
+    def getHit(self, hit):
+        if 1 <= hit <= len(self.hits):
+            return self.hits[hit-1]
+        return None
+
+    def getPeptide(self, q, p):
+        if (q, p) not in self._peptides:
+            value = self.resfile.peptideLine(self._section, q, p)
+            if value is None or value == "-1":
+                return None
+            self._peptides[(q, p)] = ms_peptide(q, p, value)
+        return self._peptides[(q, p)]
+
+    # "MW","description" by accession, from the proteins section.
+    def _protein(self, accession):
+        if self._proteins is None:
+            self._proteins = {}
+            for line in self.resfile.sectionText("proteins").splitlines():
+                key, sep, value = line.partition("=")
+                if sep:
+                    mass, _, description = value.partition(",")
+                    self._proteins[key.strip('"')] = (float(mass or 0), description.strip('"'))
+        return self._proteins.get(accession, (0.0, ""))
+
+    def getProteinDescription(self, accession):
+        return self._protein(accession)[1]
+
+    def getProteinMass(self, accession):
+        return self._protein(accession)[0]
+
+    def getProteinEmPAI(self, accession):
+        return -1
+
+    # Variable modification names by the digit used in peptide mod strings.
+    def _modNames(self):
+        if self._mods is None:
+            self._mods = {}
+            for key, value in self.resfile.section("masses").iteritems():
+                if key.startswith("delta"):
+                    self._mods[int(key[5:])] = value.partition(",")[2]
+        return self._mods
+
+    # e.g. "2 Oxidation (M); Phospho (ST)", as msparser formats them.
+    def getReadableVarMods(self, q, p):
+        pep = self.getPeptide(q, p)
+        if pep is None:
+            return ""
+        counts = {}
+        for ch in pep.varMods:
+            if ch != "0":
+                n = int(ch, 36)
+                counts[n] = counts.get(n, 0) + 1
+        names = self._modNames()
+        readable = []
+        for n in sorted(counts):
+            name = names.get(n, "Unknown")
+            readable.append(name if counts[n] == 1 else "%d %s" % (counts[n], name))
+        return "; ".join(readable)
+
+    # MASCOT's identity threshold is the ions score for which the expected
+    # number of random matches among the qmatch candidates is 1/OneInX, the
+    # homology threshold is reported in the summary as qplughole (at 1/20).
+    def getPeptideThreshold(self, q, OneInXprobRnd=20, rank=1, thresholdType=1):
+        summary  = self.resfile.section("summary")
+        qmatch   = max(float(summary.get("qmatch%d" % q, 1) or 1), 1)
+        identity = 10*math.log10(qmatch*OneInXprobRnd)
+        if thresholdType == self.TT_IDENTITY:
+            return identity
+        plughole = float(summary.get("qplughole%d" % q, 0) or 0)
+        if plughole <= 0:
+            return identity
+        return plughole + 10*math.log10(OneInXprobRnd/20.0)
+
+
+# A sidecar index of a .dat file giving the byte ranges, for every query,
+# of its queryN section (title, peaks) and of its lines in the summary and
+# peptides sections, and for every accession the (query, rank) of the
+# peptide matches to it. Built with one pass over the file and saved next
+# to it (<file>.idx), a query or protein can then be looked up by reading
+# only those ranges rather than loading the whole result file.
+class DatIndex(object):
+
+    VERSION = 2
+
+    _PEPTIDE_LINE = re.compile(r'^q(\d+)_p(\d+)(_\w+)?=([^\n]*)', re.M)
+    _SUMMARY_LINE = re.compile(r'^q[a-z_]+?(\d+)=[^\n]*', re.M)
+    _ACCESSION    = re.compile(r'"([^"]*)":')
+
+    def __init__(self, filename, size, mtime, sections, queries, accessions):
+        self.filename   = filename
+        self.size       = size
+        self.mtime      = mtime
+        # name -> (start, end) of the non-query sections.
+        self.sections   = sections
+        # 6 offsets per query (from query 0): queryN section, summary lines
+        # and peptides lines (start, end) - (0, 0) if there are none. Stored
+        # as doubles, as "L" is only 32 bits on Windows (see _offsets).
+        self.queries    = queries
+        # accession -> array of query, rank pairs.
+        self.accessions = accessions
+        self._mm        = None
+
+    @classmethod
+    def build(cls, filename):
+        resfile = ms_mascotresfile(filename)
+        if not resfile.isValid():
+            raise IOError(resfile.getLastErrorString())
+        mm = resfile._mm
+        st = os.stat(filename)
+        ranges = {}
+        def extend(q, kind, start, end):
+            offsets = ranges.setdefault(q, [0]*6)
+            if not offsets[2*kind+1]:
+                offsets[2*kind] = start
+            offsets[2*kind+1] = end
+
+        sections = {}
+        for name, (start, end) in resfile.sections.iteritems():
+            if name.startswith("query") and name[5:].isdigit():
+                extend(int(name[5:]), 0, start, end)
+            else:
+                sections[name] = (start, end)
+
+        if "summary" in resfile.sections:
+            start, end = resfile.sections["summary"]
+            for match in cls._SUMMARY_LINE.finditer(mm, start, end):
+                extend(int(match.group(1)), 1, match.start(), match.end())
+
+        accessions = {}
+        if "peptides" in resfile.sections:
+            start, end = resfile.sections["peptides"]
+            for match in cls._PEPTIDE_LINE.finditer(mm, start, end):
+                q = int(match.group(1))
+                extend(q, 2, match.start(), match.end())
+                if match.group(3) is None:
+                    rank = int(match.group(2))
+                    prots = match.group(4).partition(";")[2]
+                    for accession in set(cls._ACCESSION.findall(prots)):
+                        accessions.setdefault(accession, array.array("i")).extend((q, rank))
+
+        queries = array.array("d", [0]*6*(1+max(ranges.keys() + [resfile.getNumQueries()])))
+        for q, offsets in ranges.iteritems():
+            queries[6*q:6*q+6] = array.array("d", offsets)
+        resfile.close()
+        return cls(filename, st.st_size, st.st_mtime, sections, queries, accessions)
+
+    def save(self, indexfile):
+        import cPickle
+        state = {"version":    self.VERSION,
+                 "size":       self.size,
+                 "mtime":      self.mtime,
+                 "sections":   self.sections,
+                 "queries":    (self.queries.typecode, self.queries.tostring()),
+                 "accessions": dict((acc, pairs.tostring()) for acc, pairs in self.accessions.iteritems())}
+        tmp = indexfile + ".tmp"
+        with open(tmp, "wb") as f:
+            cPickle.dump(state, f, 2)
+        # On Windows os.rename cannot replace an existing (stale) index.
+        if os.name == "nt" and os.path.exists(indexfile):
+            os.remove(indexfile)
+        os.rename(tmp, indexfile)
+
+    # The index of filename saved in indexfile, or None if there is none or
+    # it is out of date.
+    @classmethod
+    def load(cls, filename, indexfile):
+        import cPickle
+        try:
+            with open(indexfile, "rb") as f:
+                state = cPickle.load(f)
+            st = os.stat(filename)
+        except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+            return None
+        if state.get("version") != cls.VERSION or (state["size"], state["mtime"]) != (st.st_size, st.st_mtime):
+            return None
+        typecode, data = state["queries"]
+        queries = array.array(typecode)
+        queries.fromstring(data)
+        accessions = {}
+        for acc, data in state["accessions"].iteritems():
+            accessions[acc] = array.array("i")
+            accessions[acc].fromstring(data)
+        return cls(filename, state["size"], state["mtime"], state["sections"], queries, accessions)
+
+    # Loads the index of filename from indexfile (default <filename>.idx),
+    # building and saving it first if it is missing or out of date.
+    @classmethod
+    def open(cls, filename, indexfile=None):
+        if indexfile is None:
+            indexfile = filename + ".idx"
+        index = cls.load(filename, indexfile)
+        if index is None:
+            index = cls.build(filename)
+            index.save(indexfile)
+        return index
+
+    def _text(self, start, end):
+        if self._mm is None:
+            with open(self.filename, "rb") as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mm[start:end]
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def getNumQueries(self):
+        return len(self.queries) // 6 - 1
+
+    # The 6 offsets of query q as integers.
+    def _offsets(self, q):
+        return [int(offset) for offset in self.queries[6*q:6*q+6]]
+
+    # The query's spectrum and matches: {"query", "title", "charge",
+    # "peaks": [(m/z, intensity)], "summary": {qmass etc.},
+    # "matches": [ms_peptide] by rank}, or None if q is not in the file.
+    def query(self, q):
+        import urllib
+        if not 1 <= q <= self.getNumQueries():
+            return None
+        offsets = self._offsets(q)
+        section = parseSection(self._text(offsets[0], offsets[1]))
+        peaks = []
+        for peak in section.get("Ions1", "").split(","):
+            mz, sep, intensity = peak.partition(":")
+            if sep:
+                peaks.append((float(mz), float(intensity)))
+        suffix = str(q)
+        summary = dict((key, value) for key, value in parseSection(self._text(offsets[2], offsets[3])).iteritems()
+                       if key.endswith(suffix) and key[:-len(suffix)].isalpha())
+        lines = parseSection(self._text(offsets[4], offsets[5]))
+        matches = []
+        rank = 1
+        while "q%d_p%d" % (q, rank) in lines:
+            value = lines["q%d_p%d" % (q, rank)]
+            if value != "-1":
+                matches.append(ms_peptide(q, rank, value))
+            rank += 1
+        return {"query":   q,
+                "title":   urllib.unquote(section.get("title", "")),
+                "charge":  section.get("charge", ""),
+                "peaks":   peaks,
+                "summary": summary,
+                "matches": matches}
+
+    # The peptide matches to accession, [ms_peptide] by query and rank
+    # (empty if it is not matched).
+    def protein(self, accession):
+        pairs = self.accessions.get(accession, ())
+        matches = []
+        for i in range(0, len(pairs), 2):
+            q, rank = pairs[i], pairs[i+1]
+            offsets = self._offsets(q)
+            value = parseSection(self._text(offsets[4], offsets[5])).get("q%d_p%d" % (q, rank))
+            if value is not None and value != "-1":
+                matches.append(ms_peptide(q, rank, value))
+        return matches
+
+    # (mass, description) of accession from the proteins section.
+    def proteinInfo(self, accession):
+        if "proteins" not in self.sections:
+            return 0.0, ""
+        text = self._text(*self.sections["proteins"])
+        match = re.search(r'^"%s"=([^,\n]*),"?([^\n]*?)"?\r?$' % re.escape(accession), text, re.M)
+        if match is None:
+            return 0.0, ""
+        return float(match.group(1) or 0), match.group(2)
+
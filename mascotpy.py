@@ -8,41 +8,460 @@
 #                                                                            #
 ##############################################################################
 
-import msparser
-import os, sys, optparse
+import os, sys, optparse, collections, contextlib, time, re
+import datparser
+try:
+    import msparser
+except ImportError:
+    msparser = None
+
+# Results backends: msparser as provided by Matrix Science, or the pure-python
+# reader in datparser (memory-mapped, parses sections only as needed).
+# "auto" uses msparser when it is available.
+BACKENDS = ("auto", "msparser", "native")
+
+# Returns the module providing the msparser API for the given backend name.
+def getBackend(backend="auto"):
+    if backend == "auto":
+        backend = "native" if msparser is None else "msparser"
+    if backend == "native":
+        return datparser
+    if backend == "msparser":
+        if msparser is None:
+            raise ImportError("msparser is not available, use the native backend")
+        return msparser
+    raise ValueError("Unknown results backend '%s', expected one of %s"
+                     % (backend, ", ".join(BACKENDS)))
+
+
+# Records, for --profile, the wall time, rows emitted and bytes written of
+# each stage of a conversion, how many times each msparser accessor was
+# called (on objects passed through wrap) and any other counters.
+class Profile(object):
+
+    def __init__(self):
+        self.stages   = collections.OrderedDict()
+        self.calls    = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds=0.0, rows=0, nbytes=0):
+        stage = self.stages.setdefault(name, {"seconds": 0.0, "rows": 0, "bytes": 0})
+        stage["seconds"] += seconds
+        stage["rows"]    += rows
+        stage["bytes"]   += nbytes
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    # A proxy for obj counting calls of its methods in self.calls. Hits and
+    # peptides returned through it are wrapped too.
+    def wrap(self, obj):
+        return _CountedCalls(obj, self.calls)
+
+    def report(self):
+        return {"total_seconds": sum(stage["seconds"] for stage in self.stages.values()),
+                "stages":        self.stages,
+                "calls":         self.calls,
+                "counters":      self.counters}
+
+    # Writes the report as JSON to outputfile ("-" for stdout).
+    def write(self, outputfile):
+        import json
+        report = json.dumps(self.report(), indent=1)
+        if outputfile == "-":
+            print report
+        else:
+            with open(outputfile, "w") as f:
+                f.write(report + "\n")
+
+
+# Stands in for a Profile when not profiling.
+class _NoProfile(Profile):
+
+    def add(self, name, seconds=0.0, rows=0, nbytes=0):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def wrap(self, obj):
+        return obj
+
+_NOPROFILE = _NoProfile()
+
+
+class _CountedCalls(object):
+
+    _WRAP_RESULTS = ("getHit", "getPeptide")
+
+    def __init__(self, obj, calls):
+        self._obj   = obj
+        self._calls = calls
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+        calls = self._calls
+        def counted(*args):
+            calls[name] = calls.get(name, 0) + 1
+            value = attr(*args)
+            if value and name in self._WRAP_RESULTS:
+                return _CountedCalls(value, calls)
+            return value
+        return counted
+
+
+# Opens inputfile with the given backend and builds the peptide summary.
+# Returns (resfile, params, results), or None if the file cannot be processed.
+# The resfile must be kept alive for as long as the results are in use.
+def openResults(lib,inputfile,maxHits=50,minProteinProb=0.05,minIonsScore=0,minPepLenInPepSummary=0,
+                profile=None):
+    opened = openResfile(lib, inputfile, profile)
+    if opened is None:
+        return None
+    resfile, params = opened
+    results = buildSummary(lib, resfile, maxHits, minProteinProb, minIonsScore, minPepLenInPepSummary, profile)
+    return resfile, params, results
+
+
+# Opens inputfile with the given backend, returns (resfile, params) or None
+# if the file cannot be processed.
+def openResfile(lib,inputfile,profile=None):
+
+    if profile is None:
+        profile = _NOPROFILE
+
+    with profile.stage("open"):
+        resfile = lib.ms_mascotresfile(inputfile)
+
+        if not resfile.isValid():
+            print "Cannot process file '%s':" % inputfile
+            print resfile.getLastErrorString()
+            return None
+
+        if not resfile.isMSMS():
+            print ".dat file '%s' is not an MS/MS search:" % inputfile
+            return None
+
+        params = resfile.params()
+    return resfile, params
+
+
+# Builds the peptide summary of an open resfile with the given settings.
+def buildSummary(lib,resfile,maxHits=50,minProteinProb=0.05,minIonsScore=0,minPepLenInPepSummary=0,
+                 profile=None):
+
+    if profile is None:
+        profile = _NOPROFILE
+
+    flags = lib.ms_mascotresults.MSRES_GROUP_PROTEINS \
+        | lib.ms_mascotresults.MSRES_SHOW_SUBSETS \
+        | lib.ms_mascotresults.MSRES_DUPE_REMOVE_A \
+        | lib.ms_mascotresults.MSRES_DUPE_REMOVE_B \
+        | lib.ms_mascotresults.MSRES_DUPE_REMOVE_C \
+        | lib.ms_mascotresults.MSRES_DUPE_REMOVE_D \
+        | lib.ms_mascotresults.MSRES_DUPE_REMOVE_E \
+        | lib.ms_mascotresults.MSRES_DUPE_REMOVE_F
+
+    with profile.stage("summary"):
+        results = lib.ms_peptidesummary(
+            resfile, flags, minProteinProb, maxHits, "", minIonsScore, minPepLenInPepSummary
+            )
+    return results
+
+
+# Ions score (8th field) of each rank 1 match in a peptides section.
+_RANK1_SCORE = re.compile(r"^q\d+_p1=(?:[^,;\n]*,){7}([^,;\n]*)", re.M)
+
+# Rank 1 ions scores of every query of the target (or if decoy, the decoy)
+# search in resfile. The native backend pulls them straight out of the
+# section text with a regex; with msparser they are read from a summary.
+def psmScores(lib,resfile,decoy=False):
+    if lib.__name__ == datparser.__name__:
+        return _RANK1_SCORE.findall(resfile.sectionText("decoy_peptides" if decoy else "peptides"))
+    flags = lib.ms_mascotresults.MSRES_DECOY if decoy else lib.ms_mascotresults.MSRES_NOFLAG
+    results = lib.ms_peptidesummary(resfile, flags, 1, 1, "", 0, 0)
+    scores = []
+    for q in range(1, 1+resfile.getNumQueries()):
+        pep = results.getPeptide(q, 1)
+        if pep and pep.getAnyMatch():
+            scores.append(pep.getIonsScore())
+    return scores
+
+
+# Target-decoy q-values of targets and decoys (sequences of ions scores),
+# and the lowest ions score at which the target matches have a q-value of
+# at most fdr (None if no score does). The FDR at a score is #decoys /
+# #targets scoring at least that much, and its q-value the lowest FDR at
+# that score or below. Uses numpy if available (returning arrays), so
+# millions of matches are handled without python loops.
+def qValues(targets,decoys,fdr=0.01):
+    try:
+        import numpy
+    except ImportError:
+        return _qValuesPython(targets,decoys,fdr)
+    targets = numpy.asarray(targets, dtype=float)
+    decoys  = numpy.asarray(decoys, dtype=float)
+    scores  = numpy.concatenate((targets, decoys))
+    isDecoy = numpy.concatenate((numpy.zeros(len(targets), bool), numpy.ones(len(decoys), bool)))
+    order   = numpy.argsort(-scores, kind="mergesort")
+    ranked  = scores[order]
+    nDecoy  = numpy.cumsum(isDecoy[order])
+    nTarget = numpy.arange(1, len(ranked)+1) - nDecoy
+    # Tied scores all take the counts at the last of them.
+    last = numpy.flatnonzero(numpy.append(ranked[1:] != ranked[:-1], True))
+    last = last[numpy.searchsorted(last, numpy.arange(len(ranked)))]
+    rates = nDecoy[last] / numpy.maximum(nTarget[last], 1).astype(float)
+    q = numpy.empty(len(ranked))
+    q[order] = numpy.minimum.accumulate(rates[::-1])[::-1]
+    passed = q[:len(targets)] <= fdr
+    threshold = float(targets[passed].min()) if passed.any() else None
+    return q[:len(targets)], q[len(targets):], threshold
+
+
+def _qValuesPython(targets,decoys,fdr):
+    scores = [(float(score), False) for score in targets] + [(float(score), True) for score in decoys]
+    order = sorted(range(len(scores)), key=lambda i: -scores[i][0])
+    rates = [0.0] * len(scores)
+    nDecoy = nTarget = 0
+    start = 0
+    for i, j in enumerate(order):
+        if scores[j][1]:
+            nDecoy += 1
+        else:
+            nTarget += 1
+        if i+1 == len(order) or scores[order[i+1]][0] != scores[j][0]:
+            for k in order[start:i+1]:
+                rates[k] = nDecoy / float(max(nTarget, 1))
+            start = i+1
+    q = [0.0] * len(scores)
+    best = float("inf")
+    for j in reversed(order):
+        best = min(best, rates[j])
+        q[j] = best
+    passed = [scores[i][0] for i in range(len(targets)) if q[i] <= fdr]
+    return q[:len(targets)], q[len(targets):], min(passed) if passed else None
+
+
+# The ions score threshold giving an FDR of fdr over resfile's rank 1
+# matches (see qValues), or None if the file has no decoy search or no
+# score achieves it.
+def fdrThreshold(lib,resfile,fdr=0.01,profile=None):
+    if profile is None:
+        profile = _NOPROFILE
+    with profile.stage("fdr"):
+        decoys = psmScores(lib, resfile, True)
+        if not len(decoys):
+            return None
+        targets = psmScores(lib, resfile)
+        return qValues(targets, decoys, fdr)[2]
+
 
 # Makes appropriate adjustments a string argument so it can be correctly
 # represented in LaTeX.
+# Done in a single pass over S, and strings with nothing to escape (most
+# accessions, many descriptions) are returned as they are.
+_LATEX_ESCAPES = {"\\": "\\textbackslash ",
+                  "_":  "\\_",
+                  ">":  "{\\textgreater}",
+                  "<":  "{\\textless}",
+                  "[":  "",
+                  "]":  ""}
+_LATEX_SPECIAL = re.compile(r"[\\_<>\[\]]")
+
 def latexSafe(S):
-    return S.replace("\\","\\textbackslash ")\
-            .replace("_","\\_")\
-            .replace(">","{\\textgreater}")\
-            .replace("<","{\\textless}")\
-            .replace("[","")\
-            .replace("]","")
+    if _LATEX_SPECIAL.search(S) is None:
+        return S
+    return _LATEX_SPECIAL.sub(lambda m: _LATEX_ESCAPES[m.group(0)], S)
 
 
 def main(argv):
 
     # Parse commandline options
-    print
     parser = optparse.OptionParser()
     parser.add_option('-i','--inputfile',dest='i',
-                      help="Filename to read mascot MS/MS search results from (.dat)")
+                      help="Filename to read mascot MS/MS search results from (.dat), "
+                          +"or a directory/glob of .dat files to convert as a batch")
     parser.add_option('-o','--outputfile',dest='o',
-                      help="Filename to write result too (.tex)")
+                      help="Filename to write result too (.tex, add .gz/.zst to compress, - for stdout), "
+                          +"or directory in batch mode")
     parser.add_option('-n','--max-n-proteins',action="store",dest="n",
                       default=50,type="int",help="Max number of proteins to include")
     parser.add_option('-p','--min-probability',action="store",dest="p",
                       default=0.05,type="float",help="Minimum probability to include")
+    parser.add_option('--fdr',action="store",dest="fdr",default=None,type="float",
+                      help="Only include peptide matches above the ions score threshold giving this "
+                          +"target-decoy false discovery rate, e.g. 0.01 (needs a decoy search)")
     parser.add_option('-s','--peptide-summary',action="store_true",dest="s",
                       default=False,help="Include peptide summary as well")
     parser.add_option('-c','--csv',action="store_true",dest="c",
                       default=False,help="Exports .csv Protein (Peptide if -s) summary instead of .tex")
+    parser.add_option('-f','--formats',action="store",dest="f",default=None,
+                      help="Comma separated output formats to write from a single read of the "
+                          +"input, e.g. tex,csv (-o is then the base name of the outputs)")
+    parser.add_option('--database',action="store",dest="database",default=None,
+                      help="SQLite database to load the results into (appending to it), "
+                          +"without -f/-c no other output is written")
+    parser.add_option('-m','--matrix',action="store",dest="m",default=None,type="choice",
+                      choices=sorted(METRICS),
+                      help="Write an accession x run matrix of this metric (%s) over the .dat files "
+                          % ", ".join(sorted(METRICS))
+                          +"of -i (a directory/glob) to -o, as csv or the format given by -f")
+    parser.add_option('--sweep-probability',action="store",dest="sweep_p",default=None,
+                      help="Sweep minimum probabilities: comma separated values and/or start:stop:step "
+                          +"ranges, e.g. 0.01,0.05:0.2:0.05 (see --sweep)")
+    parser.add_option('--sweep-max-hits',action="store",dest="sweep_n",default=None,
+                      help="Sweep max number of proteins (values and/or ranges)")
+    parser.add_option('--sweep-ions-score',action="store",dest="sweep_score",default=None,
+                      help="Sweep minimum ions score of peptides (values and/or ranges, default 0)")
+    parser.add_option('--sweep-pep-length',action="store",dest="sweep_len",default=None,
+                      help="Sweep minimum peptide length (values and/or ranges, default 0)")
+    parser.add_option('--sweep',action="store_true",dest="sweep",default=False,
+                      help="Open -i once and write a table of protein/peptide counts for every combination "
+                          +"of the --sweep-* values (and -p/-n otherwise) to -o (.csv); with -f also write "
+                          +"each setting's full outputs. Settings are built by -j processes")
+    parser.add_option('-q','--query',action="store",dest="q",default=None,
+                      help="Print the spectrum and peptide matches of these (comma separated) queries of -i, "
+                          +"read through an offset index of the file (built on first use)")
+    parser.add_option('--protein',action="store",dest="protein",default=None,
+                      help="Print the peptide matches of these (comma separated) accessions of -i, "
+                          +"read through the offset index")
+    parser.add_option('--index',action="store",dest="index",default=None,
+                      help="Offset index file for -q/--protein (default <inputfile>.idx)")
+    parser.add_option('-b','--backend',action="store",dest="b",
+                      default="auto",type="choice",choices=BACKENDS,
+                      help="Results backend: msparser, native (pure python) or auto (default)")
+    parser.add_option('-w','--watch',action="store",dest="w",default=None,
+                      help="Comma separated directories to watch, converting new .dat files as they "
+                          +"are completed (into -o if given) until interrupted")
+    parser.add_option('--watch-state',action="store",dest="watch_state",default=None,
+                      help="File recording already converted files in watch mode "
+                          +"(default .mascotpy_watch.json in the first watched directory)")
+    parser.add_option('--watch-stats',action="store",dest="watch_stats",default=None,
+                      help="File to keep the watch mode queue depth and latencies in (JSON)")
+    parser.add_option('-j','--jobs',action="store",dest="j",
+                      default=None,type="int",help="Number of worker processes in batch mode (default: #cpus)")
+    parser.add_option('--cache-dir',action="store",dest="cache_dir",default=None,
+                      help="Directory to cache extracted results in, re-runs with the same "
+                          +"settings then skip reading the .dat file")
+    parser.add_option('--cache-size',action="store",dest="cache_size",
+                      default=1024,type="float",help="Maximum size of the result cache in MB (default 1024)")
+    parser.add_option('--cache-key',action="store",dest="cache_key",
+                      default="hash",type="choice",choices=("hash","stat"),
+                      help="Identify cached files by content hash (default) or by size and mtime (stat)")
+    parser.add_option('--clear-cache',action="store_true",dest="clear_cache",
+                      default=False,help="Discard cached results for the input(s) before running")
+    parser.add_option('--shard-size',action="store",dest="shard_size",default=None,type="int",
+                      help="Write the .tex report as shards of this many peptide summary hits, "
+                          +"only rewriting shards that changed (rendered by -j processes)")
+    parser.add_option('-z','--compress-level',action="store",dest="z",default=None,type="int",
+                      help="Compression level for .gz/.zst outputs")
+    parser.add_option('--profile',action="store",dest="profile",default=None,
+                      help="Write per-stage timings and msparser call counts as JSON to this file (- for stdout)")
+    parser.add_option('--cprofile',action="store",dest="cprofile",default=None,
+                      help="Write a cProfile dump of the conversion to this file")
     opts, args = parser.parse_args(argv)
+    # Writing output to stdout, so send messages to stderr.
+    if opts.o == "-":
+        sys.stdout = sys.stderr
+    print
     # Check input file is provided
-    if opts.i is None:
+    if opts.i is None and opts.w is None:
         parser.error('input file not given')
+    cache = None
+    if opts.cache_dir is not None:
+        cache = ResultCache(opts.cache_dir, int(opts.cache_size*(1<<20)), opts.cache_key)
+    if opts.fdr is not None and not 0 < opts.fdr < 1:
+        parser.error('--fdr must be between 0 and 1')
+    # Abundance matrix
+    if opts.m is not None:
+        fmt = opts.f or "csv"
+        if fmt not in MATRIX_FORMATS:
+            parser.error("unknown matrix format '%s', expected one of %s" % (fmt, ", ".join(sorted(MATRIX_FORMATS))))
+        if opts.o == "-" and fmt != "csv":
+            parser.error("%s cannot be written to stdout, only csv" % fmt)
+        if opts.o is None:
+            opts.o = "matrix_" + opts.m + MATRIX_FORMATS[fmt]
+        return datMatrix(opts.i,opts.o,opts.m,fmt,opts.n,opts.p,opts.b,opts.j,cache,opts.z,opts.fdr)
+    # Query/protein lookup
+    if opts.q is not None or opts.protein is not None:
+        if opts.fdr is not None:
+            parser.error('--fdr cannot be used with -q/--protein')
+        try:
+            queries = [int(q) for q in (opts.q or "").split(",") if q.strip()]
+        except ValueError:
+            parser.error("invalid query number in '%s'" % opts.q)
+        accessions = [acc.strip() for acc in (opts.protein or "").split(",") if acc.strip()]
+        return datLookup(opts.i,queries,accessions,opts.index)
+    # Parameter sweep
+    sweeps = (opts.sweep_p, opts.sweep_n, opts.sweep_score, opts.sweep_len)
+    if opts.sweep or any(sweep is not None for sweep in sweeps):
+        if opts.fdr is not None:
+            parser.error('--fdr cannot be used with a sweep, sweep --sweep-ions-score instead')
+        try:
+            values = [parseSweep(text, kind) if text is not None else default for text, kind, default
+                      in zip(sweeps, (float, int, float, int), ([opts.p], [opts.n], [0.0], [0]))]
+        except ValueError as e:
+            parser.error("invalid sweep: %s" % e)
+        if not all(values):
+            parser.error("empty sweep")
+        sweepFormats = [fmt.strip() for fmt in (opts.f or "").split(",") if fmt.strip()]
+        for fmt in sweepFormats:
+            if fmt not in FORMATS:
+                parser.error("unknown output format '%s', expected one of %s" % (fmt, ", ".join(sorted(FORMATS))))
+        if opts.o is None:
+            opts.o = os.path.splitext(opts.i)[0] + "_sweep.csv"
+        return datSweep(opts.i,opts.o,values[1],values[0],values[2],values[3],opts.b,opts.j or 1,
+                        sweepFormats,opts.s,opts.z)
+    # Output formats, -c is short for --formats csv.
+    if opts.f is None:
+        formats = ["csv"] if opts.c else [] if opts.database is not None else ["tex"]
+    else:
+        formats = [fmt.strip() for fmt in opts.f.split(",") if fmt.strip()]
+    for fmt in formats:
+        if fmt not in FORMATS:
+            parser.error("unknown output format '%s', expected one of %s" % (fmt, ", ".join(sorted(FORMATS))))
+    if not formats and opts.database is None:
+        parser.error('no output formats given')
+    if opts.o == "-" and len(formats) > 1:
+        parser.error('only one output format can be written to stdout')
+    if opts.o == "-" and formats and formats[0] not in ("tex", "csv"):
+        parser.error("%s cannot be written to stdout, only tex or csv" % formats[0])
+    if opts.shard_size is not None:
+        if opts.o == "-":
+            parser.error('cannot write shards to stdout')
+        if opts.o is not None and os.path.splitext(opts.o)[1].lower() in (".gz", ".zst", ".zstd"):
+            parser.error('shards cannot be compressed, give -o without .gz/.zst')
+    # Watch mode
+    if opts.w is not None:
+        if opts.o == "-":
+            parser.error('cannot write to stdout in watch mode')
+        if opts.o is not None and not os.path.isdir(opts.o):
+            os.makedirs(opts.o)
+        watcher = DatWatcher([d for d in opts.w.split(",") if d],opts.o,formats,opts.n,opts.p,opts.s,
+                             opts.b,opts.j,cache,opts.shard_size,opts.watch_state,database=opts.database,
+                             fdr=opts.fdr)
+        watcher.run(statsFile=opts.watch_stats)
+        return 0
+    # Directories and glob patterns are converted as a batch.
+    if os.path.isdir(opts.i) or any(c in opts.i for c in "*?["):
+        if opts.o == "-":
+            parser.error('cannot write to stdout in batch mode')
+        if cache is not None and opts.clear_cache:
+            for inputfile in findDatFiles(opts.i):
+                cache.invalidate(inputfile)
+        summary = datBatch(opts.i,opts.o,formats,opts.n,opts.p,opts.s,opts.b,opts.j,cache,opts.shard_size,
+                           opts.database,opts.fdr)
+        return 2 if summary["failed"] else 0
     # and check that if it has a file extension, it is `.dat'
     ifile, fext = os.path.splitext(opts.i)
     if fext not in ('.dat',""):
@@ -55,10 +474,10 @@ def main(argv):
         
     # If output file is not provided default to input filename
     if opts.o is None:
-        if opts.c:
-            opts.o = ifile+'.csv'
+        if len(formats) == 1:
+            opts.o = ifile+FORMATS[formats[0]][1]
         else:
-            opts.o = ifile+'.tex'
+            opts.o = ifile
 
     # Let the user know whats up.
 ##    print "mascotpy parameters:"
@@ -71,12 +490,23 @@ def main(argv):
 ##    print "write csv:          ", opts.c
 ##    print
     
-    # Attempt to read inputfile and write outputfile,
+    # Attempt to read inputfile and write outputfile(s),
     # given maxHits minProteinProb and includePepSummary.
-    if opts.c:
-        dat2csv(opts.i,opts.o,opts.n,opts.p,opts.s)
+    if cache is not None and opts.clear_cache and os.path.isfile(opts.i):
+        cache.invalidate(opts.i)
+    profile = None if opts.profile is None else Profile()
+    if opts.cprofile is not None:
+        import cProfile
+        prof = cProfile.Profile()
+        status = prof.runcall(datConvert,opts.i,opts.o,opts.n,opts.p,opts.s,opts.b,formats,cache,profile,opts.z,
+                              opts.shard_size,opts.j,opts.database,opts.fdr)
+        prof.dump_stats(opts.cprofile)
     else:
-        dat2tex(opts.i,opts.o,opts.n,opts.p,opts.s)
+        status = datConvert(opts.i,opts.o,opts.n,opts.p,opts.s,opts.b,formats,cache,profile,opts.z,
+                            opts.shard_size,opts.j,opts.database,opts.fdr)
+    if profile is not None:
+        profile.write(opts.profile)
+    return status
     
  
 
@@ -84,315 +514,962 @@ def main(argv):
 
 
 
-def dat2tex(inputfile,outputfile=None,maxHits=50,minProteinProb=0.05,includePepSummary=False):
+# One row of the protein summary, and one row of the peptide summary (the
+# peptides matched to a protein). Masses are in Da, as msparser gives them.
+ProteinHit = collections.namedtuple("ProteinHit",
+    "accession description mass numPeptides score coverage empai")
+PeptideMatch = collections.namedtuple("PeptideMatch",
+    "query rank peptideStr varMods ionsScore identity homology")
+
+# Search parameters kept from the resfile, as reported by every writer.
+PARAMS = ("COM", "DB", "TAXONOMY", "CLE", "PFA", "MODS", "IT_MODS",
+          "TOL", "TOLU", "ITOL", "ITOLU")
+
+
+# Everything the writers need from a result file, extracted in a single pass
+# over the results so that any number of output formats can be rendered
+# without reloading the file or rebuilding the peptide summary.
+#  - params   : {name: value} for each of PARAMS.
+#  - proteins : [ProteinHit] in hit order.
+#  - peptides : [[PeptideMatch]] parallel to proteins (None if the peptide
+#               summary was not extracted).
+class Extraction(object):
+
+    def __init__(self, params, proteins, peptides=None):
+        self.params   = params
+        self.proteins = proteins
+        self.peptides = peptides
+        self._peptideIndex = None
+
+    # (ProteinHit, [PeptideMatch]) pairs in hit order.
+    def hits(self):
+        if self.peptides is None:
+            return ((prot, []) for prot in self.proteins)
+        return zip(self.proteins, self.peptides)
+
+    # The PeptideIndex of the peptide summary, built on first use.
+    def peptideIndex(self):
+        if self._peptideIndex is None:
+            self._peptideIndex = PeptideIndex.fromHits(self.hits())
+        return self._peptideIndex
+
+    # Plain python values (no namedtuples) representing the extraction, for
+    # pickling independently of how mascotpy was imported.
+    def toTuples(self):
+        peptides = None
+        if self.peptides is not None:
+            peptides = [[tuple(pep) for pep in peps] for peps in self.peptides]
+        return (self.params, [tuple(prot) for prot in self.proteins], peptides)
+
+    @classmethod
+    def fromTuples(cls, values):
+        params, proteins, peptides = values
+        if peptides is not None:
+            peptides = [[PeptideMatch._make(pep) for pep in peps] for peps in peptides]
+        return cls(params, [ProteinHit._make(prot) for prot in proteins], peptides)
+
+
+# Which protein hits (numbered from 1, as getHit) each peptide match of the
+# peptide summary was assigned to, by (query, rank) and (unless byPeptide
+# is False) by peptide string, so whether a peptide is unique to a hit or
+# shared with others is a dictionary lookup. Built in one pass over the
+# peptide assignments.
+class PeptideIndex(object):
+
+    def __init__(self, byPeptide=True):
+        # Accession of each hit, hit n at n-1.
+        self.accessions = []
+        self.byPeptide  = byPeptide
+        # (query, rank) -> hits, and peptide string -> hits, ascending. Most
+        # matches belong to one hit, which is kept as a plain int.
+        self._matches  = {}
+        self._peptides = {}
+
+    # Adds the next hit, returns its number.
+    def addHit(self, accession):
+        self.accessions.append(accession)
+        return len(self.accessions)
+
+    # Records that hit (added last) contains the match of query at rank, of
+    # peptide sequence peptideStr.
+    def add(self, hit, query, rank, peptideStr=None):
+        self._add(self._matches, (query, rank), hit)
+        if self.byPeptide:
+            self._add(self._peptides, peptideStr, hit)
+
+    @staticmethod
+    def _add(table, key, hit):
+        hits = table.get(key)
+        if hits is None:
+            table[key] = hit
+        elif type(hits) is int:
+            if hits != hit:
+                table[key] = [hits, hit]
+        elif hits[-1] != hit:
+            hits.append(hit)
+
+    @staticmethod
+    def _lookup(table, key):
+        hits = table.get(key, [])
+        return [hits] if type(hits) is int else hits
+
+    @classmethod
+    def fromHits(cls, hits):
+        index = cls()
+        for prot, peptides in hits:
+            hit = index.addHit(prot.accession)
+            for pep in peptides:
+                index.add(hit, pep.query, pep.rank, pep.peptideStr)
+        return index
+
+    # Hits containing the match of query at rank.
+    def hits(self, query, rank):
+        return self._lookup(self._matches, (query, rank))
+
+    # Hits containing a match to the peptide sequence peptideStr.
+    def hitsOfPeptide(self, peptideStr):
+        if not self.byPeptide:
+            raise ValueError("peptide index built without peptide sequences")
+        return self._lookup(self._peptides, peptideStr)
+
+    def isUnique(self, query, rank):
+        return len(self.hits(query, rank)) <= 1
+
+    # Number of hits the match of query at rank is shared between, less one
+    # (0 if it is unique).
+    def numShared(self, query, rank):
+        return max(len(self.hits(query, rank)) - 1, 0)
+
+    # Accessions of the hits other than hit containing the match of query
+    # at rank.
+    def sharedWith(self, hit, query, rank):
+        return [self.accessions[other-1] for other in self.hits(query, rank) if other != hit]
+
+
+# An (opt-in) on-disk cache of Extractions, so re-running on the same .dat
+# with the same summary settings skips loading it altogether. Entries are
+# zlib compressed pickles keyed by the input file, either by a digest of its
+# content (keyBy="hash") or its path, size and mtime (keyBy="stat"), and the
+# summary settings. Once the cache holds more than maxBytes, least recently
+# used entries are removed.
+class ResultCache(object):
+
+    VERSION = 1
+    EXT = ".mpcache"
+
+    def __init__(self, directory, maxBytes=1<<30, keyBy="hash"):
+        if keyBy not in ("hash", "stat"):
+            raise ValueError("keyBy must be 'hash' or 'stat', not '%s'" % keyBy)
+        self.directory = directory
+        self.maxBytes  = maxBytes
+        self.keyBy     = keyBy
+
+    def fileKey(self, inputfile):
+        import hashlib
+        digest = hashlib.sha1()
+        if self.keyBy == "stat":
+            st = os.stat(inputfile)
+            digest.update(repr( (os.path.abspath(inputfile), st.st_size, st.st_mtime) ))
+        else:
+            with open(inputfile, "rb") as f:
+                for block in iter(lambda: f.read(1<<20), ""):
+                    digest.update(block)
+        return digest.hexdigest()[:20]
+
+    def _path(self, inputfile, settings):
+        import hashlib
+        skey = hashlib.sha1(repr( (self.VERSION,) + tuple(settings) )).hexdigest()[:20]
+        return os.path.join(self.directory, self.fileKey(inputfile) + "-" + skey + self.EXT)
+
+    # The cached Extraction for inputfile and settings, or None.
+    def get(self, inputfile, settings):
+        import cPickle, zlib
+        path = self._path(inputfile, settings)
+        try:
+            with open(path, "rb") as f:
+                data = Extraction.fromTuples(cPickle.loads(zlib.decompress(f.read())))
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            print "warning: ignoring unreadable cache entry", path, "(%s)" % e
+            return None
+        # Bump the entry to most recently used.
+        os.utime(path, None)
+        return data
+
+    def put(self, inputfile, settings, data):
+        import cPickle, zlib, tempfile
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self._path(inputfile, settings)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(zlib.compress(cPickle.dumps(data.toTuples(), cPickle.HIGHEST_PROTOCOL), 1))
+        replaceFile(tmp, path)
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith(self.EXT):
+                    path = os.path.join(self.directory, name)
+                    st = os.stat(path)
+                    entries.append( (st.st_mtime, st.st_size, path) )
+        return sorted(entries)
+
+    # Removes least recently used entries until the cache fits in maxBytes.
+    def evict(self):
+        entries = self._entries()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.maxBytes:
+                break
+            os.remove(path)
+            total -= size
+
+    # Removes the entries of inputfile (all entries if None), returns how
+    # many were removed.
+    def invalidate(self, inputfile=None):
+        prefix = "" if inputfile is None else self.fileKey(inputfile) + "-"
+        removed = 0
+        for mtime, size, path in self._entries():
+            if os.path.basename(path).startswith(prefix):
+                os.remove(path)
+                removed += 1
+        return removed
 
-    # Parse input parameters.
-    if not __name__ == "__main__":
-        inputfile, fileExtension = os.path.splitext(inputfile)
-        if not fileExtension == ".dat":
-            print "Invalid File extension on input file '"+fileExtension+"'"
-            print "Attempting to find", inputfile+".dat instead.\n"
-        # If no output file was specified use the input filename (.tex)
-        if outputfile is None:
-            outputfile = inputfile+".tex"
-        inputfile = inputfile+".dat"
+
+# Memoizes the per-query lookups of a peptide summary: getReadableVarMods
+# and the identity and homology getPeptideThreshold of a match are kept as
+# one entry per (query, rank). In grouped results the same query turns up
+# under many protein hits, so this makes the peptide summary cost
+# proportional to the number of distinct queries. At most maxsize entries
+# are kept, least recently used first out (the default covers 200k-query
+# searches, loadResults sizes it from the number of queries); hits and
+# misses count lookups.
+class QueryCache(object):
+
+    def __init__(self, results, maxsize=250000):
+        self.results = results
+        self.maxsize = maxsize
+        self.hits    = 0
+        self.misses  = 0
+        self._cache  = collections.OrderedDict()
+
+    def _get(self, key, compute):
         try:
-            maxHits = int(maxHits)
-        except ValueError as e:
-            print "Exception in parameter maxNprot:"
-            print e
+            value = self._cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            value = compute()
+            self.misses += 1
+            if len(self._cache) >= self.maxsize:
+                self._cache.popitem(last=False)
+        self._cache[key] = value
+        return value
+
+    # (readable var mods, identity threshold, homology threshold) of the
+    # match of query q at rank. Thresholds are those of the query's rank 1
+    # match, as the peptide summary reports them.
+    def match(self, q, rank, OneInXprobRnd, identityType, homologyType):
+        return self._get( (q, rank, OneInXprobRnd),
+                          lambda: (self.results.getReadableVarMods(q, rank),
+                                   self.results.getPeptideThreshold(q, OneInXprobRnd, 1, identityType),
+                                   self.results.getPeptideThreshold(q, OneInXprobRnd, 1, homologyType)) )
+
+    def __len__(self):
+        return len(self._cache)
+
+
+# Walks results.getHit/getPeptide, yielding a (ProteinHit, [PeptideMatch])
+# pair per hit (with no peptides unless includePepSummary). Per-query lookups
+# go through queryCache (a new QueryCache is used if not given). Time spent
+# on the protein and peptide summary is recorded in profile, if given.
+def iterHits(lib,results,minProteinProb=0.05,includePepSummary=False,queryCache=None,profile=None):
+
+    TT_IDENTITY = lib.ms_mascotresults.TT_IDENTITY
+    TT_HOMOLOGY = lib.ms_mascotresults.TT_HOMOLOGY
+    if profile is None:
+        profile = _NOPROFILE
+    results = profile.wrap(results)
+    if queryCache is None:
+        queryCache = QueryCache(results)
+
+    hit  = 1
+    start = time.time()
+    prot = results.getHit(hit)
+    while prot:
+        accession = prot.getAccession()
+        num_peps  = prot.getNumPeptides()
+        protein = ProteinHit(accession,
+                             results.getProteinDescription(accession),
+                             results.getProteinMass(accession),
+                             num_peps,
+                             prot.getScore(),
+                             prot.getCoverage(),
+                             results.getProteinEmPAI(accession))
+        profile.add("protein_summary", time.time() - start, 1)
+        matches = []
+        if includePepSummary:
+            start = time.time()
+            for i in range(1, 1+num_peps):
+                q = prot.getPeptideQuery(i)
+                p = prot.getPeptideP(i)
+                if p == -1 or q == -1:
+                    continue
+                pep = results.getPeptide(q, p)
+                if not pep:
+                    continue
+                rank = pep.getRank()
+                var_mods, identity, homology = queryCache.match(q, rank, 1/minProteinProb, TT_IDENTITY, TT_HOMOLOGY)
+                matches.append(PeptideMatch(q, rank,
+                                            pep.getPeptideStr(),
+                                            var_mods,
+                                            pep.getIonsScore(),
+                                            identity,
+                                            homology))
+            profile.add("peptide_summary", time.time() - start, len(matches))
+        yield protein, matches
+        hit += 1
+        start = time.time()
+        prot = results.getHit(hit)
+
+    profile.count("query_cache_hits", queryCache.hits)
+    profile.count("query_cache_misses", queryCache.misses)
+
+
+# The search parameters (PARAMS) of a resfile as a dictionary.
+def paramsDict(params):
+    return dict((name, getattr(params, "get"+name)()) for name in PARAMS)
+
+
+# Walks the results once (see iterHits) into an Extraction.
+def extractResults(lib,params,results,minProteinProb=0.05,includePepSummary=False,queryCache=None,
+                   profile=None):
+    proteins = []
+    peptides = [] if includePepSummary else None
+    for protein, matches in iterHits(lib,results,minProteinProb,includePepSummary,queryCache,profile):
+        proteins.append(protein)
+        if includePepSummary:
+            peptides.append(matches)
+    return Extraction(paramsDict(params), proteins, peptides)
+
+
+# An Extraction whose hits are read from the results while being written, so
+# the extracted hits are never all held in memory. hits() can be iterated
+# only once and proteins/peptides are not available; only writers in
+# STREAMING_FORMATS can render it. For the peptide summary a (query, rank)
+# peptide index has to be built beforehand (see indexPeptides), which does
+# take memory in proportion to the number of peptide assignments.
+class StreamedExtraction(Extraction):
+
+    def __init__(self, params, hits, resfile=None, peptideIndex=None):
+        Extraction.__init__(self, params, None, None)
+        self._hits = hits
+        # msparser needs the resfile to outlive the results being streamed.
+        self._resfile = resfile
+        self._peptideIndex = peptideIndex
+
+    def hits(self):
+        return self._hits
+
+    def peptideIndex(self):
+        if self._peptideIndex is None:
+            raise ValueError("the peptide index of a streamed extraction must be built beforehand")
+        return self._peptideIndex
+
+
+# Builds the (query, rank) PeptideIndex of results from the hits' peptide
+# query/P numbers alone (P is the rank), without reading the peptides, so
+# it has no peptide sequences (see byPeptide). The peptide_index stage of
+# profile counts the assignments indexed as rows.
+def indexPeptides(results,profile=None):
+    if profile is None:
+        profile = _NOPROFILE
+    rows = 0
+    with profile.stage("peptide_index"):
+        index = PeptideIndex(byPeptide=False)
+        prot = results.getHit(1)
+        while prot:
+            hit = index.addHit(prot.getAccession())
+            for i in range(1, 1+prot.getNumPeptides()):
+                q = prot.getPeptideQuery(i)
+                p = prot.getPeptideP(i)
+                if p == -1 or q == -1:
+                    continue
+                index.add(hit, q, p)
+                rows += 1
+            prot = results.getHit(hit+1)
+    profile.add("peptide_index", rows=rows)
+    return index
+
+
+# Opens inputfile and extracts its results, returns an Extraction or an exit
+# status (2) if the file could not be processed. If a ResultCache is given
+# it is used in place of reading the file where possible. If stream, the
+# results are returned as a StreamedExtraction instead (and not cached). If
+# fdr is given, peptide matches scoring below the target-decoy threshold for
+# that FDR (see fdrThreshold) are left out of the summary.
+def loadResults(inputfile,maxHits=50,minProteinProb=0.05,includePepSummary=False,backend="auto",cache=None,
+                profile=None,stream=False,fdr=None):
+    if profile is None:
+        profile = _NOPROFILE
+    try:
+        lib = getBackend(backend)
+    except (ImportError, ValueError) as e:
+        print e
+        return 2
+
+    if cache is not None and not stream:
+        settings = (lib.__name__, maxHits, minProteinProb, includePepSummary)
+        if fdr is not None:
+            settings += (fdr,)
+        try:
+            with profile.stage("cache_load"):
+                data = cache.get(inputfile, settings)
+        except (IOError, OSError) as e:
+            print "warning: result cache not used:", e
+            cache = None
+            data = None
+        if data is not None:
+            return data
+
+    opened = openResfile(lib, inputfile, profile)
+    if opened is None:
+        return 2
+    resfile, params = opened
+    minIonsScore = 0
+    if fdr is not None:
+        minIonsScore = fdrThreshold(lib, resfile, fdr, profile)
+        if minIonsScore is None:
+            print "Cannot control the FDR of '%s' at %g: no decoy matches, or none of the scores reach it" \
+                  % (inputfile, fdr)
             return 2
+        print "%s: ions score threshold %.2f for an FDR of %g" % (inputfile, minIonsScore, fdr)
+    results = buildSummary(lib, resfile, maxHits, minProteinProb, minIonsScore, profile=profile)
+    # Room for two ranks of every query, so no repeated lookup is evicted.
+    queryCache = QueryCache(profile.wrap(results), max(250000, 2*resfile.getNumQueries()))
+    if stream:
+        return StreamedExtraction(paramsDict(params),
+                                  iterHits(lib, results, minProteinProb, includePepSummary, queryCache, profile),
+                                  resfile, indexPeptides(profile.wrap(results), profile) if includePepSummary else None)
+    data = extractResults(lib, params, results, minProteinProb, includePepSummary, queryCache, profile)
+
+    if cache is not None:
         try:
-            minProteinProb = float(minProteinProb)
-        except ValueError as e:
-            print "Exception in parameter minProb:"
-            print e
+            with profile.stage("cache_store"):
+                cache.put(inputfile, settings, data)
+        except (IOError, OSError) as e:
+            print "warning: could not write to result cache:", e
+    return data
+
+
+# Checks the arguments of the module-level functions (dat2tex, dat2csv,
+# datConvert) when used from python rather than the commandline. Returns
+# (inputfile, outputfile, maxHits, minProteinProb, includePepSummary), with
+# outputfile defaulting to the input filename with extension ext, or None
+# (having printed why) if they are invalid.
+def checkArgs(inputfile,outputfile,ext,maxHits,minProteinProb,includePepSummary):
+    if __name__ == "__main__":
+        return inputfile, outputfile, maxHits, minProteinProb, includePepSummary
+    inputfile, fileExtension = os.path.splitext(inputfile)
+    if not fileExtension == ".dat":
+        print "Invalid File extension on input file '"+fileExtension+"'"
+        print "Attempting to find", inputfile+".dat instead.\n"
+    # If no output file was specified use the input filename
+    if outputfile is None:
+        outputfile = inputfile+ext
+    inputfile = inputfile+".dat"
+    try:
+        maxHits = int(maxHits)
+    except ValueError as e:
+        print "Exception in parameter maxNprot:"
+        print e
+        return None
+    try:
+        minProteinProb = float(minProteinProb)
+    except ValueError as e:
+        print "Exception in parameter minProb:"
+        print e
+        return None
+    try:
+        includePepSummary = bool(includePepSummary)
+    except ValueError as e:
+        print "Exception in parameter includePepSummary:"
+        print e
+        return None
+    return inputfile, outputfile, maxHits, minProteinProb, includePepSummary
+
+
+def dat2tex(inputfile,outputfile=None,maxHits=50,minProteinProb=0.05,includePepSummary=False,backend="auto",
+            profile=None,shardSize=None,jobs=1):
+    return datConvert(inputfile,outputfile,maxHits,minProteinProb,includePepSummary,backend,("tex",),
+                      profile=profile,shardSize=shardSize,jobs=jobs)
+
+
+def dat2csv(inputfile,outputfile=None,maxHits=50,minProteinProb=0.05,includePepSummary=False,backend="auto",
+            profile=None,compressLevel=None):
+    return datConvert(inputfile,outputfile,maxHits,minProteinProb,includePepSummary,backend,("csv",),
+                      profile=profile,compressLevel=compressLevel)
+
+
+# (seconds, rows) recorded so far for the protein and peptide summaries.
+def _extractionStages(profile):
+    stages = [profile.stages[name] for name in ("protein_summary", "peptide_summary")
+              if name in profile.stages]
+    return sum(stage["seconds"] for stage in stages), sum(stage["rows"] for stage in stages)
+
+
+# Reads inputfile once and writes each of the requested formats (see
+# FORMATS). With a single format outputfile is used as given, with several
+# it is the base name each format's extension is appended to. Results are
+# cached in cache (a ResultCache) if given. Pass a Profile as profile to
+# record where the time goes. A single streaming format (csv) without a
+# cache is written while the results are read, in bounded memory. Text
+# outputs are compressed if outputfile ends in .gz/.zst, "-" is stdout. With
+# a shardSize the tex report is sharded (see writeTexShards), rendered by
+# jobs processes. If database is given the results are also loaded into that
+# SQLite store (see storeSqlite). If fdr is given the summaries only include
+# peptide matches passing target-decoy FDR control at that rate.
+def datConvert(inputfile,outputfile=None,maxHits=50,minProteinProb=0.05,includePepSummary=False,
+               backend="auto",formats=("tex",),cache=None,profile=None,compressLevel=None,
+               shardSize=None,jobs=1,database=None,fdr=None):
+
+    formats = list(formats)
+    for fmt in formats:
+        if fmt not in FORMATS:
+            print "Unknown output format '%s', expected one of %s" % (fmt, ", ".join(sorted(FORMATS)))
             return 2
+    ext = FORMATS[formats[0]][1] if len(formats) == 1 else ""
+    args = checkArgs(inputfile,outputfile,ext,maxHits,minProteinProb,includePepSummary)
+    if args is None:
+        return 2
+    inputfile, outputfile, maxHits, minProteinProb, includePepSummary = args
+
+    if profile is None:
+        profile = _NOPROFILE
+    # Not streamed into a database, the store would stay locked while reading.
+    stream = cache is None and database is None and len(formats) == 1 and formats[0] in STREAMING_FORMATS
+    data = loadResults(inputfile,maxHits,minProteinProb,includePepSummary,backend,cache,profile,stream,fdr)
+    if not isinstance(data, Extraction):
+        return data
+
+    if not stream:
+        rows = len(data.proteins)
+        if includePepSummary and data.peptides is not None:
+            rows += sum(len(peps) for peps in data.peptides)
+    for fmt in formats:
+        writer, fext = FORMATS[fmt]
+        path = outputfile if len(formats) == 1 else outputfile+fext
+        start = time.time()
+        extracted = _extractionStages(profile)
         try:
-            minProteinProb = bool(includePepSummary)
-        except ValueError as e:
-            print "Exception in parameter includePepSummary:"
-            print e
+            if fmt == "tex" and shardSize:
+                shards = writeTexShards(data, path, includePepSummary, shardSize, jobs)
+                print "%s: %d shards written, %d unchanged, %d removed" % (
+                    path, len(shards["written"]), len(shards["unchanged"]), len(shards["removed"]))
+            else:
+                writer(data, path, includePepSummary, compressLevel)
+        except ImportError as e:
+            print "Cannot write %s output: %s" % (fmt, e)
             return 2
-    
-    resfile = msparser.ms_mascotresfile(inputfile)
-    params = resfile.params()
+        # When streaming, extraction happens during the write.
+        seconds = time.time() - start
+        if stream:
+            seconds -= _extractionStages(profile)[0] - extracted[0]
+            rows = _extractionStages(profile)[1] - extracted[1]
+        profile.add("write_"+fmt, seconds, rows,
+                    os.path.getsize(path) if os.path.isfile(path) else 0)
+    if database is not None:
+        import sqlite3
+        start = time.time()
+        try:
+            storeSqlite(data, database, inputfile, maxHits, minProteinProb, includePepSummary)
+        except sqlite3.Error as e:
+            print "Cannot store results in %s: %s" % (database, e)
+            return 2
+        profile.add("store_sqlite", time.time() - start, rows, os.path.getsize(database))
 
-    if not resfile.isValid():
-        print "Cannot process file '%s':" % inputfile
-        print resfile.getLastErrorString()
-        return 2
 
-    if not resfile.isMSMS():
-        print ".dat file '%s' is not an MS/MS search:" % inputfile
-        return 2
 
-    flags = msparser.ms_mascotresults.MSRES_GROUP_PROTEINS \
-        | msparser.ms_mascotresults.MSRES_SHOW_SUBSETS \
-        | msparser.ms_mascotresults.MSRES_DUPE_REMOVE_A \
-        | msparser.ms_mascotresults.MSRES_DUPE_REMOVE_B \
-        | msparser.ms_mascotresults.MSRES_DUPE_REMOVE_C \
-        | msparser.ms_mascotresults.MSRES_DUPE_REMOVE_D \
-        | msparser.ms_mascotresults.MSRES_DUPE_REMOVE_E \
-        | msparser.ms_mascotresults.MSRES_DUPE_REMOVE_F
 
-    minIonsScore = 0
-    minPepLenInPepSummary = 0
-    results = msparser.ms_peptidesummary(
-        resfile, flags, minProteinProb, maxHits, "", minIonsScore, minPepLenInPepSummary
-        )
-
-    # Write output .tex file.
-    with open(outputfile,"w") as tex:
-
-        # Preamble
-        tex.write("\\documentclass{article}\n\n\n"
-                  +"\\usepackage[landscape,margin=2cm]{geometry}\n"
-                  +"\\usepackage{multicol}\n"
-                  +"\\usepackage{longtable}\n\n\n")
-        
-        # Document begin, title.
-        tex.write("\\begin{document}\n\n"
-                  +"\\begin{center}\n"
-                  +"  {\\Huge "+latexSafe(params.getCOM())+"}\n"
-                  +"\\end{center}\n\n")
 
+# Buffers writes to raw into blocks of at least blockSize bytes, so that the
+# many small writes of the writers reach the file (or compressor) in large
+# chunks. Closing flushes, and closes raw unless it is stdout.
+class BlockSink(object):
+
+    def __init__(self, raw, blockSize=1<<20, closeRaw=True, closers=()):
+        self.raw       = raw
+        self.blockSize = blockSize
+        self.closeRaw  = closeRaw
+        self.closers   = closers
+        self._parts    = []
+        self._size     = 0
+
+    def write(self, text):
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self.blockSize:
+            self.flush()
+
+    def flush(self):
+        if self._parts:
+            self.raw.write("".join(self._parts))
+            self._parts = []
+            self._size  = 0
+
+    def close(self):
+        self.flush()
+        if self.closeRaw:
+            self.raw.close()
+            for closer in self.closers:
+                closer.close()
+        else:
+            self.raw.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Opens outputfile for writing by the text writers: "-" is stdout, a ".gz"
+# extension writes gzip, ".zst" zstandard (needs the zstandard package),
+# compressed at compressLevel (gzip 6, zstd 3 by default). Anything else is
+# a plain file.
+def openSink(outputfile,compressLevel=None,blockSize=1<<20):
+    if outputfile == "-":
+        return BlockSink(sys.__stdout__, blockSize, closeRaw=False)
+    ext = os.path.splitext(outputfile)[1].lower()
+    if ext == ".gz":
+        import gzip
+        level = 6 if compressLevel is None else compressLevel
+        return BlockSink(gzip.open(outputfile, "wb", level), blockSize)
+    if ext in (".zst", ".zstd"):
+        import zstandard
+        level = 3 if compressLevel is None else compressLevel
+        raw = open(outputfile, "wb")
+        return BlockSink(zstandard.ZstdCompressor(level=level).stream_writer(raw), blockSize,
+                         closers=(raw,))
+    return BlockSink(open(outputfile, "wb"), blockSize)
+
+
+# Splits s into its first `first` characters followed by chunks of `rest`
+# characters, the way the tex tables wrap long descriptions and peptides.
+def wrapText(s,first,rest):
+    return [s[:first]] + [s[i:i+rest] for i in range(first, len(s), rest)]
+
+
+# Renders the .tex report of an Extraction. Rows are assembled into large
+# chunks rather than written piecemeal, and escaping is done once: escaped
+# (and wrapped) descriptions are memoized per accession, escaped variable
+# modifications per modification.
+class TexRenderer(object):
+
+    PROT_WRAP_DESC   = 45
+    PROT_INDENT_DESC = 5
+    PEP_WRAP_DESC    = 85
+    PEP_INDENT_DESC  = 15
+    PEP_WRAP_STR     = 25
+    PEP_INDENT_STR   = 5
+
+    def __init__(self, chunkSize=256):
+        # Number of hits rendered per chunk written.
+        self.chunkSize = chunkSize
+        self._mods = {}
+
+    # Escaped lines of a description wrapped to `first` then `first-indent`
+    # characters.
+    def description(self, prot, first, indent):
+        return [latexSafe(line) for line in wrapText(prot.description, first, first-indent)]
+
+    # Escaped modification name, memoized as the same few recur on every
+    # peptide.
+    def varMod(self, mod):
+        escaped = self._mods.get(mod)
+        if escaped is None:
+            escaped = self._mods[mod] = latexSafe(mod)
+        return escaped
+
+    # Preamble, title and the MASCOT search parameters page.
+    def header(self, params):
+        return self.preamble() + self.parameters(params)
+
+    # Preamble, document begin.
+    def preamble(self):
+        return ("\\documentclass{article}\n\n\n"
+                "\\usepackage[landscape,margin=2cm]{geometry}\n"
+                "\\usepackage{multicol}\n"
+                "\\usepackage{longtable}\n\n\n"
+                "\\begin{document}\n\n")
+
+    # Title and the MASCOT search parameters page.
+    def parameters(self, params):
+        out = []
+        # Title.
+        out.append("\\begin{center}\n"
+                   "  {\\Huge "+latexSafe(params["COM"])+"}\n"
+                   "\\end{center}\n\n")
         # MASCOT Search Parameters
-        tex.write("\\vspace{2cm}\n"\
-                  +"\\begin{center}\n"\
-                  +"  {\\Large MASCOT Search Parameters}\n"\
-                  +"\\end{center}\n"\
-                  +"\\begin{center}\n"\
-                  +"\t\\begin{longtable}{rl}\n")
+        out.append("\\vspace{2cm}\n"
+                   "\\begin{center}\n"
+                   "  {\\Large MASCOT Search Parameters}\n"
+                   "\\end{center}\n"
+                   "\\begin{center}\n"
+                   "\t\\begin{longtable}{rl}\n")
         # - database
-        tex.write(2*"  " + "Database : & " + latexSafe(params.getDB()) + " \\\\\n")
+        out.append("    Database : & " + latexSafe(params["DB"]) + " \\\\\n")
         # - taxonomy (remove preceeding dots '. . .')
-        dot_loc = params.getTAXONOMY()[::-1].find(".")
+        tax_name = params["TAXONOMY"]
+        dot_loc = tax_name.rfind(".")
         if dot_loc != -1:
-            tax_name = params.getTAXONOMY()[(len(params.getTAXONOMY())-dot_loc):]
-        else:
-            tax_name = params.getTAXONOMY()
-        tex.write(2*"  " + "Taxonomy : & " + latexSafe(tax_name) + " \\\\\n")
+            tax_name = tax_name[dot_loc+1:]
+        out.append("    Taxonomy : & " + latexSafe(tax_name) + " \\\\\n")
         # - enzyme (missed cleavages)
-        enz_name = params.getCLE()
-        n_missed_cleave = params.getPFA()
+        n_missed_cleave = params["PFA"]
         if n_missed_cleave == 0:
             cleave_sentence = "no missed cleavages"
         elif n_missed_cleave == 1:
             cleave_sentence = "up to " + str(n_missed_cleave) + " missed cleavage"
         else:
             cleave_sentence = "up to " + str(n_missed_cleave) + " missed cleavages"
-        tex.write(2*"  " + "Enzyme : & "+ latexSafe(enz_name) + " (" + cleave_sentence + ") \\\\\n")
-        # - fixed modifications
-        tex.write(2*"  " + "Fixed Modifications :")
-        mods_fixed = params.getMODS().split(",")
-        extra_ws = 1
-        for mod in mods_fixed:
-            tex.write(extra_ws*" " + "& " + latexSafe(mod) + " \\\\\n")
-            extra_ws = 2*2 + 22
-        # - variable modifications
-        tex.write(2*"  " + "Variable Modifications :")
-        mods_variable = params.getIT_MODS().split(",")
-        extra_ws = 1
-        for mod in mods_variable:
-            tex.write(extra_ws*" " + "& " + latexSafe(mod) + " \\\\\n")
-            extra_ws = 2*2 + 25
+        out.append("    Enzyme : & "+ latexSafe(params["CLE"]) + " (" + cleave_sentence + ") \\\\\n")
+        # - fixed and variable modifications, one per row.
+        for title, mods in (("Fixed Modifications :", params["MODS"]),
+                            ("Variable Modifications :", params["IT_MODS"])):
+            out.append("    " + title)
+            extra_ws = 1
+            for mod in mods.split(","):
+                out.append(extra_ws*" " + "& " + latexSafe(mod) + " \\\\\n")
+                extra_ws = 4 + len(title) + 1
         # - mass tolerances
-        tex.write(2*"  " + "MS Mass Tolerance : & {0} {1} \\\\\n".format(params.getTOL(),params.getTOLU()) \
-                  + 2*"  " + "MS/MS Mass Tolerance : & {0} {1} \\\\\n".format(params.getITOL(),params.getITOLU()) \
-                  + "  " + "\\end{longtable}\n" \
-                  + "\\end{center}\n\n")
+        out.append("    MS Mass Tolerance : & {0} {1} \\\\\n".format(params["TOL"],params["TOLU"])
+                   + "    MS/MS Mass Tolerance : & {0} {1} \\\\\n".format(params["ITOL"],params["ITOLU"])
+                   + "  \\end{longtable}\n"
+                   + "\\end{center}\n\n")
+        return "".join(out)
 
-        # Protein Summary
-        tex.write("\\pagebreak\n"\
-                  + "\\begin{center}\n" \
-                  + "  " + "{\\Large \\textbf{Protein Summary}}\n"\
-                  + "\\end{center}\n"\
-                  + "\\begin{center}\n"\
-                  + "  " + "\\begin{longtable}{llccccc}\n"\
-                  + 2*"  " + "\\textbf{Accession} & \\textbf{Protein} & \\textbf{MW (kDa)} & \\textbf{IDs} & \\textbf{Score} & \\textbf{Coverage} & \\textbf{emPAI} \\\\ \\hline\n")
-        prot_wrap_desc = 45
-        prot_indent_desc = 5
-        hit  = 1
-        prot = results.getHit(hit)
-        while prot:
-            accession   = prot.getAccession()
-            tex.write(2*"  " + latexSafe(accession) + "\n")
-            # - curtail descriptions that are too long.
-            description = results.getProteinDescription(accession)
-            if len(description) <= prot_wrap_desc:
-                tex.write(2*"  " + "& " + latexSafe(description) + "\n")
-            else:
-                tex.write(2*"  " + "& " + latexSafe(description[:prot_wrap_desc]) + "\n")
-            tex.write(2*"  " + "& {0:.2f} %Mass\n".format(results.getProteinMass(accession)/1000)\
-                      + 2*"  " + "& {0} %IDs\n".format(prot.getNumPeptides())\
-                      + 2*"  " + "& {0:.2f} %Score\n".format(prot.getScore())\
-                      + 2*"  " + "& {0} %Coverage\n".format(prot.getCoverage())\
-                      + 2*"  " + "& {0:.2f} %emPAI\n".format(results.getProteinEmPAI(accession))\
-                      + 2*"  " + "\\\\\n")
-            # - include remaining description as wrapped text.
-            prot_loc_desc = prot_wrap_desc
-            while prot_loc_desc < len(description):
-                if len(description) - prot_loc_desc < (prot_wrap_desc-prot_indent_desc):
-                    tex.write(2*"  " + "&" + prot_indent_desc*" " + "\\hspace{"+str(prot_indent_desc)+"ex}" + latexSafe(description[prot_loc_desc:]) + 5*" &" + " \\\\\n")
+    def proteinSummaryBegin(self):
+        return ("\\pagebreak\n"
+                "\\begin{center}\n"
+                "  {\\Large \\textbf{Protein Summary}}\n"
+                "\\end{center}\n"
+                "\\begin{center}\n"
+                "  \\begin{longtable}{llccccc}\n"
+                "    \\textbf{Accession} & \\textbf{Protein} & \\textbf{MW (kDa)} & \\textbf{IDs} & \\textbf{Score} & \\textbf{Coverage} & \\textbf{emPAI} \\\\ \\hline\n")
+
+    # Rows of one protein in the protein summary, appended to out.
+    def proteinRows(self, prot, out):
+        # - curtail descriptions that are too long.
+        lines = self.description(prot, self.PROT_WRAP_DESC, self.PROT_INDENT_DESC)
+        out.append("    " + latexSafe(prot.accession) + "\n"
+                   "    & " + lines[0] + "\n"
+                   "    & {0:.2f} %Mass\n"
+                   "    & {1} %IDs\n"
+                   "    & {2:.2f} %Score\n"
+                   "    & {3} %Coverage\n"
+                   "    & {4:.2f} %emPAI\n"
+                   "    \\\\\n".format(prot.mass/1000, prot.numPeptides, prot.score, prot.coverage, prot.empai))
+        # - include remaining description as wrapped text.
+        wrapped = "    &" + self.PROT_INDENT_DESC*" " + "\\hspace{" + str(self.PROT_INDENT_DESC) + "ex}"
+        for line in lines[1:]:
+            out.append(wrapped + line + " & & & & & \\\\\n")
+
+    def peptideSummaryBegin(self):
+        return ("\\pagebreak\n"
+                "\\begin{center}\n"
+                "  {\\Large \\textbf{Peptide Summary}}\n"
+                "\\end{center}\n"
+                + self.peptideTableBegin())
+
+    def peptideTableBegin(self):
+        return ("\\begin{center}\n"
+                "  \\begin{longtable}{llccc}\n")
+
+    # Rows of one protein and its peptides in the peptide summary, appended
+    # to out. shared gives, for each peptide, the number of other hits it is
+    # also assigned to (see PeptideIndex.numShared).
+    def peptideRows(self, prot, peptides, shared, out):
+        out.append("    \\multicolumn{5}{c}{\\textbf{" + latexSafe(prot.accession) + "}} \\\\\n")
+        for line in self.description(prot, self.PEP_WRAP_DESC, self.PEP_INDENT_DESC):
+            out.append("    \\multicolumn{5}{c}{\\textbf{" + line + "}} \\\\\n")
+        out.append("    & & & & \\\\\n"
+                   "    & \\textbf{Variable} & &  \\textbf{(Identity/Homology)} & \\textbf{Shared} \\\\\n"
+                   "    \\textbf{Peptide} & \\textbf{Modifications} & \\textbf{Score} & \\textbf{Thresholds} & \\textbf{(Other Hits)} \\\\ \\hline\n")
+        indent = "    " + self.PEP_INDENT_STR*" "
+        wrap, rest = self.PEP_WRAP_STR, self.PEP_WRAP_STR-self.PEP_INDENT_STR
+        for pep, others in zip(peptides, shared):
+            pep_str  = pep.peptideStr
+            var_mods = pep.varMods
+            out.append("    " + pep_str[:wrap] + " \n"
+                       "    & " + self.varMod(var_mods.partition("; ")[0])
+                       + " & {0:.1f} & ({1:.1f}/{2:.1f}) & {3} \\\\\n".format(pep.ionsScore, pep.identity, pep.homology,
+                                                                          others or "--"))
+            # - continue long peptides and further modifications on
+            #   following rows.
+            if len(pep_str) <= wrap and "; " not in var_mods:
+                continue
+            pep_lines = wrapText(pep_str, wrap, rest)
+            var_mods  = var_mods.split("; ")
+            for i in range(1, max(len(pep_lines), len(var_mods))):
+                if i >= len(var_mods):
+                    out.append(indent + pep_lines[i] + " & & & & \\\\\n")
+                elif i >= len(pep_lines):
+                    out.append("    & " + self.varMod(var_mods[i]) + " & & & \\\\\n")
                 else:
-                    tex.write(2*"  " + "&" + prot_indent_desc*" " + "\\hspace{"+str(prot_indent_desc)+"ex}" + latexSafe(description[prot_loc_desc:(prot_loc_desc+(prot_wrap_desc-prot_indent_desc))]) + 5*" &" + " \\\\\n")
-                prot_loc_desc += (prot_wrap_desc-prot_indent_desc)
-            hit += 1
-            prot = results.getHit(hit)
-        tex.write("  " + "\\end{longtable}\n"\
-                  + "\\end{center}\n\n")
+                    out.append(indent + pep_lines[i] + " & " + self.varMod(var_mods[i]) + " & & & \\\\\n")
+        out.append("    & & & & \\\\\n"
+                   "    & & & & \\\\\n"
+                   "    & & & & \\\\\n")
+
+    def tableEnd(self):
+        return ("  \\end{longtable}\n"
+                "\\end{center}\n\n")
 
+    # Writes rows(item, out) for each of items to tex, chunkSize at a time.
+    def _writeRows(self, tex, items, rows):
+        out = []
+        for n, item in enumerate(items, 1):
+            rows(*item, out=out)
+            if n % self.chunkSize == 0:
+                tex.write("".join(out))
+                out = []
+        tex.write("".join(out))
+
+    def render(self, data, tex, includePepSummary=False):
+        tex.write(self.header(data.params))
+        # Protein Summary
+        tex.write(self.proteinSummaryBegin())
+        self._writeRows(tex, ((prot,) for prot in data.proteins), self.proteinRows)
+        tex.write(self.tableEnd())
         # Peptide Summary
         if includePepSummary:
-            tex.write("\\pagebreak\n"\
-                      + "\\begin{center}\n"\
-                      + "  " + "{\\Large \\textbf{Peptide Summary}}\n"\
-                      + "\\end{center}\n"\
-                      + "\\begin{center}\n"\
-                      + "  " + "\\begin{longtable}{llcc}\n")
-            pep_wrap_desc = 85
-            pep_indent_desc = 15
-            pep_wrap_str = 25
-            pep_indent_str = 5
-            hit  = 1
-            prot = results.getHit(hit)
-            while prot:
-                accession   = prot.getAccession()
-                description = results.getProteinDescription(accession)
-                num_peps = prot.getNumPeptides()
-                tex.write(2*"  " + "\\multicolumn{4}{c}{\\textbf{"+latexSafe(accession)+"}} \\\\\n")
-                if len(description) <= pep_wrap_desc:
-                    tex.write(2*"  " + "\\multicolumn{4}{c}{\\textbf{"+latexSafe(description)+"}} \\\\\n")
-                else:
-                    tex.write(2*"  " + "\\multicolumn{4}{c}{\\textbf{"+latexSafe(description[:85])+"}} \\\\\n")
-                pep_loc_desc = pep_wrap_desc
-                while pep_loc_desc < len(description):
-                    if len(description) - pep_loc_desc < (pep_wrap_desc - pep_indent_desc) :
-                        tex.write(2*"  " + "\\multicolumn{4}{c}{\\textbf{"+latexSafe(description[pep_loc_desc:])+"}} \\\\\n")
-                    else:
-                        tex.write(2*"  " + "\\multicolumn{4}{c}{\\textbf{"+latexSafe(description[pep_loc_desc:(pep_loc_desc+(pep_wrap_desc - pep_indent_desc))])+"}} \\\\\n")
-                    pep_loc_desc += (pep_wrap_desc - pep_indent_desc)
-                tex.write(2*"  " + "& & & \\\\\n"\
-                          + 2*"  " + "& \\textbf{Variable} & &  \\textbf{(Identity/Homology)} \\\\\n"\
-                          + 2*"  " + "\\textbf{Peptide} & \\textbf{Modifications} & \\textbf{Score} & \\textbf{Thresholds} \\\\ \\hline\n")
-                for i in range(1, 1+num_peps):
-                    q = prot.getPeptideQuery(i)
-                    p = prot.getPeptideP(i)
-                    if p == -1 or q == -1:
-                        continue
-                    pep = results.getPeptide(q, p)
-                    if not pep:
-                        continue
-                    pep_str = pep.getPeptideStr()
-                    var_mods = results.getReadableVarMods(q, pep.getRank()).split("; ")
-                    if len(pep_str) <= pep_wrap_str :
-                        tex.write(2*"  " + pep_str + " \n")
-                    else:
-                        tex.write(2*"  " + pep_str[:pep_wrap_str] + " \n")
-                    tex.write(2*"  " + "& " + latexSafe(var_mods[0])\
-                              + " & {0:.1f}".format(pep.getIonsScore())\
-                              + " & ({0:.1f}/{1:.1f})".format(results.getPeptideThreshold(q,1/minProteinProb,1,msparser.ms_mascotresults.TT_IDENTITY),\
-                              results.getPeptideThreshold(q,1/minProteinProb,1,msparser.ms_mascotresults.TT_HOMOLOGY)) + " \\\\\n")
-                    pep_loc_var_mods = 1
-                    pep_loc_str = pep_wrap_str
-                    while (pep_loc_var_mods < len(var_mods)) or (pep_loc_str < len(pep_str)):
-                        if not (pep_loc_var_mods < len(var_mods)) and (pep_loc_str < len(pep_str)):
-                            if len(pep_str) - pep_loc_str < (pep_wrap_str - pep_indent_str):
-                                tex.write(2*"  " + pep_indent_str*" " + pep_str[pep_loc_str:] + " & & & \\\\\n")
-                            else:
-                                tex.write(2*"  " + pep_indent_str*" " + \
-                                          pep_str[pep_loc_str:(pep_loc_str+(pep_wrap_str - pep_indent_str))] + " & & & \\\\\n")
-                        elif (pep_loc_var_mods < len(var_mods)) and  not (pep_loc_str < len(pep_str)):
-                            tex.write(2*"  " + "& " + latexSafe(var_mods[pep_loc_var_mods]) + " & & \\\\\n")
-                        elif (pep_loc_var_mods < len(var_mods)) and (pep_loc_str < len(pep_str)):
-                            if len(pep_str) - pep_loc_str < (pep_wrap_str - pep_indent_str):
-                                tex.write(2*"  " + pep_indent_str*" " + pep_str[pep_loc_str:]\
-                                          + " & " + latexSafe(var_mods[pep_loc_var_mods]) + " & & \\\\\n")
-                            else:
-                                tex.write(2*"  " + pep_indent_str*" " + \
-                                          pep_str[pep_loc_str:(pep_loc_str+(pep_wrap_str - pep_indent_str))]\
-                                          + " & " + latexSafe(var_mods[pep_loc_var_mods]) + " & & \\\\\n")
-                        pep_loc_str += (pep_wrap_str - pep_indent_str)
-                        pep_loc_var_mods += 1
-                tex.write(2*"  " + "& & & \\\\\n"\
-                          + 2*"  " + "& & & \\\\\n"\
-                          +2*"  " + "& & & \\\\\n")
-                hit += 1
-                prot = results.getHit(hit)
-            tex.write("  " + "\\end{longtable}\n"\
-                      + "\\end{center}\n\n")
-        
+            tex.write(self.peptideSummaryBegin())
+            index = data.peptideIndex()
+            self._writeRows(tex, ((prot, peptides, [index.numShared(pep.query, pep.rank) for pep in peptides])
+                                  for prot, peptides in data.hits()), self.peptideRows)
+            tex.write(self.tableEnd())
         tex.write("\\end{document}")
 
 
+# Writes the .tex report (protein summary, and peptide summary if
+# includePepSummary) of an Extraction to outputfile.
+def writeTex(data,outputfile,includePepSummary=False,compressLevel=None):
+    with openSink(outputfile,compressLevel) as tex:
+        TexRenderer().render(data, tex, includePepSummary)
 
 
 
-def dat2csv(inputfile,outputfile=None,maxHits=50,minProteinProb=0.05,includePepSummary=False):
 
-    import csv
-    
-    # Parse input parameters.
-    if not __name__ == "__main__":
-        inputfile, fileExtension = os.path.splitext(inputfile)
-        if not fileExtension == ".dat":
-            print "Invalid File extension on input file '"+fileExtension+"'"
-            print "Attempting to find", inputfile+".dat instead.\n"
-        # If no output file was specified use the input filename (.csv)
-        if outputfile is None:
-            outputfile = inputfile+".csv"
-        inputfile = inputfile+".dat"
-        try:
-            maxHits = int(maxHits)
-        except ValueError as e:
-            print "Exception in parameter maxNprot:"
-            print e
-            return 2
-        try:
-            minProteinProb = float(minProteinProb)
-        except ValueError as e:
-            print "Exception in parameter minProb:"
-            print e
-            return 2
+
+# Renders one shard of a sharded tex report, in a worker process if the
+# shards are rendered in parallel. job is (kind, values) with values plain
+# tuples (see Extraction.toTuples). Returns (text, sha1 of text).
+def _renderTexShard(job):
+    import hashlib
+    kind, values = job
+    renderer = TexRenderer()
+    if kind == "params":
+        text = renderer.parameters(values)
+    elif kind == "proteins":
+        out = [renderer.proteinSummaryBegin()]
+        for prot in values:
+            renderer.proteinRows(ProteinHit._make(prot), out)
+        out.append(renderer.tableEnd())
+        text = "".join(out)
+    else:
+        first, hits = values
+        out = [renderer.peptideSummaryBegin() if first else renderer.peptideTableBegin()]
+        for prot, peptides, shared in hits:
+            renderer.peptideRows(ProteinHit._make(prot), [PeptideMatch._make(pep) for pep in peptides], shared,
+                                 out)
+        out.append(renderer.tableEnd())
+        text = "".join(out)
+    return text, hashlib.sha1(text).hexdigest()
+
+
+# Writes the .tex report as a main file (outputfile) that \input's separate
+# shards: <name>_params.tex, <name>_proteins.tex and, if includePepSummary,
+# the peptide summary in <name>_peptides_NNNN.tex shards of shardSize hits
+# each, so pdflatex never has to hold one huge table. The fingerprint of
+# every shard is kept in <name>.shards, and on a re-run only shards whose
+# content changed are rewritten (and shards no longer needed removed).
+# Shards are rendered by a pool of jobs processes if jobs > 1. Returns
+# {"written": [...], "unchanged": [...], "removed": [...]} filenames.
+def writeTexShards(data,outputfile,includePepSummary=False,shardSize=500,jobs=1):
+    import json, hashlib
+    base = os.path.splitext(outputfile)[0]
+    params, proteins, peptides = data.toTuples()
+
+    shards = [(base+"_params.tex", ("params", params)),
+              (base+"_proteins.tex", ("proteins", proteins))]
+    if includePepSummary and peptides is not None:
+        index = data.peptideIndex()
+        hits = [(prot, peps, [index.numShared(pep[0], pep[1]) for pep in peps])
+                for prot, peps in zip(proteins, peptides)]
+        for n, i in enumerate(range(0, len(hits), shardSize), 1):
+            shards.append( ("%s_peptides_%04d.tex" % (base, n), ("peptides", (i == 0, hits[i:i+shardSize]))) )
+
+    if jobs is not None and jobs > 1 and len(shards) > 2:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
         try:
-            minProteinProb = bool(includePepSummary)
-        except ValueError as e:
-            print "Exception in parameter includePepSummary:"
-            print e
-            return 2
-    
-    resfile = msparser.ms_mascotresfile(inputfile)
-    params = resfile.params()
+            rendered = pool.map(_renderTexShard, [job for path, job in shards])
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        rendered = [_renderTexShard(job) for path, job in shards]
 
-    if not resfile.isValid():
-        print "Cannot process file '%s':" % inputfile
-        print resfile.getLastErrorString()
-        return 2
+    renderer = TexRenderer()
+    main = renderer.preamble() \
+           + "".join("\\input{%s}\n" % os.path.splitext(os.path.basename(path))[0] for path, job in shards) \
+           + "\n\\end{document}"
+    outputs = [(path, text, digest) for (path, job), (text, digest) in zip(shards, rendered)]
+    outputs.append( (outputfile, main, hashlib.sha1(main).hexdigest()) )
 
-    if not resfile.isMSMS():
-        print ".dat file '%s' is not an MS/MS search:" % inputfile
-        return 2
+    manifest = base + ".shards"
+    try:
+        with open(manifest) as f:
+            previous = json.load(f)
+    except (IOError, ValueError):
+        previous = {}
 
-    flags = msparser.ms_mascotresults.MSRES_GROUP_PROTEINS \
-        | msparser.ms_mascotresults.MSRES_SHOW_SUBSETS \
-        | msparser.ms_mascotresults.MSRES_DUPE_REMOVE_A \
-        | msparser.ms_mascotresults.MSRES_DUPE_REMOVE_B \
-        | msparser.ms_mascotresults.MSRES_DUPE_REMOVE_C \
-        | msparser.ms_mascotresults.MSRES_DUPE_REMOVE_D \
-        | msparser.ms_mascotresults.MSRES_DUPE_REMOVE_E \
-        | msparser.ms_mascotresults.MSRES_DUPE_REMOVE_F
+    report = {"written": [], "unchanged": [], "removed": []}
+    fingerprints = {}
+    for path, text, digest in outputs:
+        key = os.path.basename(path)
+        fingerprints[key] = digest
+        if previous.get(key) == digest and os.path.isfile(path):
+            report["unchanged"].append(path)
+            continue
+        with openSink(path) as tex:
+            tex.write(text)
+        report["written"].append(path)
+    for key in previous:
+        path = os.path.join(os.path.dirname(base), key)
+        if key not in fingerprints and os.path.isfile(path):
+            os.remove(path)
+            report["removed"].append(path)
+    with open(manifest, "w") as f:
+        json.dump(fingerprints, f, indent=1, sort_keys=True)
+    return report
 
-    minIonsScore = 0
-    minPepLenInPepSummary = 0
-    results = msparser.ms_peptidesummary(
-        resfile, flags, minProteinProb, maxHits, "", minIonsScore, minPepLenInPepSummary
-        )
+
+# Writes the protein summary (or peptide summary if includePepSummary) of an
+# Extraction to outputfile as .csv.
+def writeCsv(data,outputfile,includePepSummary=False,compressLevel=None):
+
+    import csv
 
     # Write output .csv file.
-    with open(outputfile,"w") as ofile:
+    with openSink(outputfile,compressLevel) as ofile:
         writer = csv.writer(ofile)
-        
+
         if includePepSummary:
             # Peptide Summary
             writer.writerow( ("Accession",
@@ -401,32 +1478,23 @@ def dat2csv(inputfile,outputfile=None,maxHits=50,minProteinProb=0.05,includePepS
                               "VariableModifications",
                               "Score",
                               "IdentityThreshold",
-                              "HomologyThreshold") )
-            hit  = 1
-            prot = results.getHit(hit)
-            while prot:
-                accession = prot.getAccession()
-                description = results.getProteinDescription(accession)
-                num_peps = prot.getNumPeptides()
-                for i in range(1, 1+num_peps):
-                    q = prot.getPeptideQuery(i)
-                    p = prot.getPeptideP(i)
-                    if p == -1 or q == -1:
-                        continue
-                    pep = results.getPeptide(q, p)
-                    if not pep:
-                        continue
-                    writer.writerow( (accession,
-                                      description,
-                                      pep.getPeptideStr(),
-                                      results.getReadableVarMods(q, pep.getRank()),
-                                      "{0:.1f}".format(pep.getIonsScore()),
-                                      "{0:.1f}".format(results.getPeptideThreshold(q,1/minProteinProb,1,msparser.ms_mascotresults.TT_IDENTITY)),
-                                      "{0:.1f}".format(results.getPeptideThreshold(q,1/minProteinProb,1,msparser.ms_mascotresults.TT_HOMOLOGY))
+                              "HomologyThreshold",
+                              "Unique",
+                              "SharedWith") )
+            index = data.peptideIndex()
+            for hit, (prot, peptides) in enumerate(data.hits(), 1):
+                for pep in peptides:
+                    shared = index.sharedWith(hit, pep.query, pep.rank)
+                    writer.writerow( (prot.accession,
+                                      prot.description,
+                                      pep.peptideStr,
+                                      pep.varMods,
+                                      "{0:.1f}".format(pep.ionsScore),
+                                      "{0:.1f}".format(pep.identity),
+                                      "{0:.1f}".format(pep.homology),
+                                      "no" if shared else "yes",
+                                      ";".join(shared)
                                       ) )
-                                      
-                hit += 1
-                prot = results.getHit(hit)
                 
         else:
             # Protein Summary
@@ -437,25 +1505,850 @@ def dat2csv(inputfile,outputfile=None,maxHits=50,minProteinProb=0.05,includePepS
                               "Score",
                               "Coverage",
                               "emPAI") )
-            hit  = 1
-            prot = results.getHit(hit)
-            while prot:
-                accession = prot.getAccession()
-                writer.writerow( (accession,
-                                  results.getProteinDescription(accession),
-                                  "{0:.2f}".format(results.getProteinMass(accession)/1000),
-                                  "{0}".format(prot.getNumPeptides()),
-                                  "{0:.2f}".format(prot.getScore()),
-                                  "{0}".format(prot.getCoverage()),
-                                  "{0:.2f}".format(results.getProteinEmPAI(accession))) )
-                hit += 1
-                prot = results.getHit(hit)
-        
+            for prot, peptides in data.hits():
+                writer.writerow( (prot.accession,
+                                  prot.description,
+                                  "{0:.2f}".format(prot.mass/1000),
+                                  "{0}".format(prot.numPeptides),
+                                  "{0:.2f}".format(prot.score),
+                                  "{0}".format(prot.coverage),
+                                  "{0:.2f}".format(prot.empai)) )
 
 
 
 
-        
+
+
+# The protein summary and peptide summary of an Extraction as typed columns,
+# [(name, type, values)] with type one of "str", "int" or "float". Values are
+# kept at full precision (masses in Da). Peptide rows refer to their protein
+# by hit number (1-based, as getHit) and accession.
+def columnarTables(data):
+    proteins = [
+        ("hit",         "int",   range(1, 1+len(data.proteins))),
+        ("accession",   "str",   [prot.accession for prot in data.proteins]),
+        ("description", "str",   [prot.description for prot in data.proteins]),
+        ("mass",        "float", [prot.mass for prot in data.proteins]),
+        ("ids",         "int",   [prot.numPeptides for prot in data.proteins]),
+        ("score",       "float", [prot.score for prot in data.proteins]),
+        ("coverage",    "int",   [prot.coverage for prot in data.proteins]),
+        ("empai",       "float", [prot.empai for prot in data.proteins])]
+    peptides = None
+    if data.peptides is not None:
+        hits = [(i, prot, pep) for i, (prot, peps) in enumerate(data.hits(), 1) for pep in peps]
+        peptides = [
+            ("hit",        "int",   [hit for hit, prot, pep in hits]),
+            ("accession",  "str",   [prot.accession for hit, prot, pep in hits]),
+            ("query",      "int",   [pep.query for hit, prot, pep in hits]),
+            ("rank",       "int",   [pep.rank for hit, prot, pep in hits]),
+            ("peptide",    "str",   [pep.peptideStr for hit, prot, pep in hits]),
+            ("var_mods",   "str",   [pep.varMods for hit, prot, pep in hits]),
+            ("ions_score", "float", [pep.ionsScore for hit, prot, pep in hits]),
+            ("identity",   "float", [pep.identity for hit, prot, pep in hits]),
+            ("homology",   "float", [pep.homology for hit, prot, pep in hits])]
+    return proteins, peptides
+
+
+# A column in .npy format (version 1.0), written without needing numpy:
+# float64, int32 or fixed width byte strings.
+def npyBytes(kind, values):
+    import array, struct
+    order = "<" if sys.byteorder == "little" else ">"
+    if kind == "float":
+        descr, body = order+"f8", array.array("d", values).tostring()
+    elif kind == "int":
+        descr, body = order+"i4", array.array("i", values).tostring()
+    else:
+        width = max([len(v) for v in values] + [1])
+        descr, body = "|S%d" % width, "".join(v.ljust(width, "\0") for v in values)
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (descr, len(values))
+    # Pad so the data starts 64-byte aligned.
+    header += " " * (63 - (len(header) + 10) % 64) + "\n"
+    return "\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header + body
+
+
+# Writes the protein (and peptide if includePepSummary) summary columns to a
+# .npz archive, as protein_<column> and peptide_<column> arrays. Members are
+# stored uncompressed, so np.load reads them without parsing.
+def writeNpz(data,outputfile,includePepSummary=False,compressLevel=None):
+    import zipfile
+    proteins, peptides = columnarTables(data)
+    tables = [("protein", proteins)]
+    if includePepSummary and peptides is not None:
+        tables.append( ("peptide", peptides) )
+    with zipfile.ZipFile(outputfile, "w", zipfile.ZIP_STORED, allowZip64=True) as npz:
+        for table, columns in tables:
+            for name, kind, values in columns:
+                npz.writestr(table + "_" + name + ".npy", npyBytes(kind, values))
+
+
+# The columns as a pyarrow Table (pyarrow is optional, only needed for the
+# arrow and parquet formats).
+def _arrowTable(columns):
+    import pyarrow
+    types = {"str": pyarrow.string(), "int": pyarrow.int32(), "float": pyarrow.float64()}
+    return pyarrow.Table.from_arrays(
+        [pyarrow.array(values, type=types[kind]) for name, kind, values in columns],
+        [name for name, kind, values in columns])
+
+
+# Output files of the arrow/parquet writers: the protein summary goes to
+# outputfile, the peptide summary next to it as <name>_peptides<ext>.
+def _columnarOutputs(data,outputfile,includePepSummary):
+    proteins, peptides = columnarTables(data)
+    outputs = [(outputfile, proteins)]
+    if includePepSummary and peptides is not None:
+        name, ext = os.path.splitext(outputfile)
+        outputs.append( (name+"_peptides"+ext, peptides) )
+    return outputs
+
+
+def writeArrow(data,outputfile,includePepSummary=False,compressLevel=None):
+    import pyarrow
+    for path, columns in _columnarOutputs(data,outputfile,includePepSummary):
+        table = _arrowTable(columns)
+        writer = pyarrow.RecordBatchFileWriter(path, table.schema)
+        writer.write_table(table)
+        writer.close()
+
+
+def writeParquet(data,outputfile,includePepSummary=False,compressLevel=None):
+    import pyarrow.parquet
+    for path, columns in _columnarOutputs(data,outputfile,includePepSummary):
+        pyarrow.parquet.write_table(_arrowTable(columns), path)
+
+
+# Formats whose writers make a single pass over data.hits(), so can be
+# written from a StreamedExtraction.
+STREAMING_FORMATS = ("csv",)
+
+# Output formats: name -> (writer(data, outputfile, includePepSummary, compressLevel), file extension).
+# Writers of the text formats compress according to the extension of
+# outputfile (see openSink), the others ignore compressLevel.
+FORMATS = {"tex":     (writeTex, ".tex"),
+           "csv":     (writeCsv, ".csv"),
+           "npz":     (writeNpz, ".npz"),
+           "arrow":   (writeArrow, ".arrow"),
+           "parquet": (writeParquet, ".parquet")}
+
+
+
+
+
+
+# Schema of the SQLite results store: one row of runs per loaded .dat file
+# (with its search parameters), and the protein and peptide summaries of
+# every run, indexed for cross-run queries by accession and peptide.
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run INTEGER PRIMARY KEY, source TEXT UNIQUE NOT NULL, size INTEGER, mtime REAL, loaded REAL,
+    max_hits INTEGER, min_probability REAL, peptide_summary INTEGER,
+    %s);
+CREATE TABLE IF NOT EXISTS proteins (
+    run INTEGER NOT NULL REFERENCES runs(run), hit INTEGER NOT NULL, accession TEXT NOT NULL,
+    description TEXT, mass REAL, ids INTEGER, score REAL, coverage INTEGER, empai REAL);
+CREATE TABLE IF NOT EXISTS peptides (
+    run INTEGER NOT NULL REFERENCES runs(run), hit INTEGER NOT NULL, accession TEXT NOT NULL,
+    query INTEGER, rank INTEGER, peptide TEXT, var_mods TEXT,
+    ions_score REAL, identity REAL, homology REAL);
+CREATE INDEX IF NOT EXISTS proteins_run ON proteins(run, hit);
+CREATE INDEX IF NOT EXISTS proteins_accession ON proteins(accession, score);
+CREATE INDEX IF NOT EXISTS peptides_run ON peptides(run, hit);
+CREATE INDEX IF NOT EXISTS peptides_accession ON peptides(accession);
+CREATE INDEX IF NOT EXISTS peptides_peptide ON peptides(peptide);
+""" % ",\n    ".join(name.lower() + " " + {"PFA": "INTEGER", "TOL": "REAL", "ITOL": "REAL"}.get(name, "TEXT")
+                      for name in PARAMS)
+
+
+# Opens (creating if need be) a SQLite results store. Several processes may
+# load into the same store, writers wait up to timeout seconds for each other.
+def openDatabase(database,timeout=60.0):
+    import sqlite3
+    conn = sqlite3.connect(database, timeout)
+    # Descriptions are byte strings, stored and read back as such.
+    conn.text_factory = str
+    conn.execute("PRAGMA journal_mode=WAL")
+    # Create the schema holding the write lock, so processes opening a new
+    # store at the same time do not trip over each other.
+    conn.isolation_level = None
+    conn.execute("BEGIN IMMEDIATE")
+    for statement in SQLITE_SCHEMA.split(";"):
+        conn.execute(statement)
+    conn.execute("COMMIT")
+    conn.isolation_level = ""
+    return conn
+
+
+# Loads data (an Extraction, read from source) into the SQLite store
+# database as a run, replacing any earlier load of the same source so that
+# re-running on a file keeps one copy of it. The whole run is one
+# transaction, rows are inserted with executemany in batches of batchSize.
+# Returns the run's id.
+def storeSqlite(data,database,source,maxHits=50,minProteinProb=0.05,includePepSummary=False,
+                batchSize=5000):
+    source = os.path.abspath(source)
+    try:
+        st = os.stat(source)
+        size, mtime = st.st_size, st.st_mtime
+    except OSError:
+        size, mtime = None, None
+    conn = openDatabase(database)
+    try:
+        with conn:
+            # Take the write lock before looking for an earlier load, so two
+            # processes loading the same source cannot both miss it.
+            conn.execute("BEGIN IMMEDIATE")
+            old = conn.execute("SELECT run FROM runs WHERE source = ?", (source,)).fetchone()
+            if old is not None:
+                for table in ("peptides", "proteins", "runs"):
+                    conn.execute("DELETE FROM %s WHERE run = ?" % table, old)
+            run = conn.execute(
+                "INSERT INTO runs (source, size, mtime, loaded, max_hits, min_probability, peptide_summary, %s) "
+                "VALUES (%s)" % (", ".join(name.lower() for name in PARAMS), ", ".join("?"*(7+len(PARAMS)))),
+                (source, size, mtime, time.time(), maxHits, minProteinProb, int(bool(includePepSummary)))
+                + tuple(data.params.get(name) for name in PARAMS)).lastrowid
+            proteins, peptides = [], []
+            for hit, (prot, peps) in enumerate(data.hits(), 1):
+                proteins.append( (run, hit, prot.accession, prot.description, prot.mass,
+                                  prot.numPeptides, prot.score, prot.coverage, prot.empai) )
+                if includePepSummary:
+                    peptides.extend( (run, hit, prot.accession, pep.query, pep.rank, pep.peptideStr,
+                                      pep.varMods, pep.ionsScore, pep.identity, pep.homology)
+                                     for pep in peps )
+                if len(proteins) >= batchSize or len(peptides) >= batchSize:
+                    conn.executemany("INSERT INTO proteins VALUES (?,?,?,?,?,?,?,?,?)", proteins)
+                    conn.executemany("INSERT INTO peptides VALUES (?,?,?,?,?,?,?,?,?,?)", peptides)
+                    proteins, peptides = [], []
+            conn.executemany("INSERT INTO proteins VALUES (?,?,?,?,?,?,?,?,?)", proteins)
+            conn.executemany("INSERT INTO peptides VALUES (?,?,?,?,?,?,?,?,?,?)", peptides)
+    finally:
+        conn.close()
+    return run
+
+
+# The runs of the SQLite store database that identified accession with a
+# score of at least minScore: [(source, hit, score, ids, emPAI)], best first.
+# Raises IOError if database does not exist.
+def findProtein(database,accession,minScore=0):
+    import sqlite3
+    # Only reading, so no schema set up (or write lock), and no new file.
+    if not os.path.isfile(database):
+        raise IOError("no results store '%s'" % database)
+    conn = sqlite3.connect(database, 60.0)
+    conn.text_factory = str
+    try:
+        return conn.execute(
+            "SELECT runs.source, proteins.hit, proteins.score, proteins.ids, proteins.empai "
+            "FROM proteins JOIN runs USING (run) WHERE proteins.accession = ? AND proteins.score >= ? "
+            "ORDER BY proteins.score DESC", (accession, minScore)).fetchall()
+    finally:
+        conn.close()
+
+
+
+
+
+
+# Expands a directory (all .dat files in it) or a glob pattern into a sorted
+# list of input files.
+def findDatFiles(pattern):
+    import glob
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*.dat")
+    return sorted(f for f in glob.glob(pattern) if os.path.isfile(f))
+
+
+# Set up once in each batch worker process, so the results backend (and so
+# msparser) is only resolved/imported once per worker rather than per file.
+_batchBackend = None
+
+def _initBatchWorker(backend):
+    global _batchBackend
+    # Ctrl-C is handled by the parent, which terminates the pool.
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    getBackend(backend)
+    _batchBackend = backend
+
+
+# Converts one file in a batch, never raising so one bad file cannot abort
+# the rest of the batch. Returns (inputfile, error, seconds, bytes read).
+def _batchWorker(job):
+    (inputfile, outputfile, formats, maxHits, minProteinProb, includePepSummary, cache, shardSize, database,
+     fdr) = job
+    start = time.time()
+    try:
+        size = os.path.getsize(inputfile)
+        status = datConvert(inputfile,outputfile,maxHits,minProteinProb,includePepSummary,
+                            _batchBackend,formats,cache,shardSize=shardSize,database=database,fdr=fdr)
+        error = None if not status else "exit status %d" % status
+    except Exception as e:
+        size = 0
+        error = "%s: %s" % (type(e).__name__, e)
+    return inputfile, error, time.time() - start, size
+
+
+# The job _batchWorker converts inputfile with, writing next to the input or
+# into outputdir if given (and loading it into the SQLite store database).
+def _batchJob(inputfile,outputdir,formats,maxHits,minProteinProb,includePepSummary,cache,shardSize,
+              database=None,fdr=None):
+    ext = FORMATS[formats[0]][1] if len(formats) == 1 else ""
+    outputfile = os.path.splitext(inputfile)[0] + ext
+    if outputdir is not None:
+        outputfile = os.path.join(outputdir, os.path.basename(outputfile))
+    return (inputfile, outputfile, tuple(formats), maxHits, minProteinProb, includePepSummary, cache,
+            shardSize, database, fdr)
+
+
+# Converts every .dat file matched by pattern (a directory or glob) to each of
+# the given formats across a pool of jobs worker processes. Outputs are written next
+# to the inputs, or into outputdir if given, and every file is loaded into
+# the SQLite store database if given (fdr as for datConvert). Returns a
+# summary dictionary with per-file failures and the overall throughput.
+def datBatch(pattern,outputdir=None,formats=("tex",),maxHits=50,minProteinProb=0.05,
+             includePepSummary=False,backend="auto",jobs=None,cache=None,shardSize=None,database=None,
+             fdr=None):
+    import multiprocessing
+
+    if outputdir is not None and not os.path.isdir(outputdir):
+        os.makedirs(outputdir)
+    batch = [_batchJob(inputfile,outputdir,formats,maxHits,minProteinProb,includePepSummary,cache,shardSize,
+                       database,fdr)
+             for inputfile in findDatFiles(pattern)]
+
+    start = time.time()
+    failed = {}
+    nbytes = 0
+    pool = multiprocessing.Pool(jobs, _initBatchWorker, (backend,))
+    try:
+        for inputfile, error, seconds, size in pool.imap_unordered(_batchWorker, batch):
+            nbytes += size
+            if error is None:
+                print "ok     %6.2fs  %s" % (seconds, inputfile)
+            else:
+                failed[inputfile] = error
+                print "FAILED %6.2fs  %s (%s)" % (seconds, inputfile, error)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    elapsed = max(time.time() - start, 1e-9)
+
+    summary = {"files":          len(batch),
+               "succeeded":      len(batch) - len(failed),
+               "failed":         failed,
+               "seconds":        elapsed,
+               "files_per_s":    len(batch) / elapsed,
+               "mb_per_s":       nbytes / 1e6 / elapsed}
+    print
+    print "%d files (%d failed) in %.2fs: %.2f files/s, %.2f MB/s" \
+          % (summary["files"], len(failed), elapsed, summary["files_per_s"], summary["mb_per_s"])
+    return summary
+
+
+
+
+
+
+# os.rename(src, dst), replacing dst if it exists; on Windows os.rename
+# fails if dst exists, so it is removed first there.
+def replaceFile(src, dst):
+    if os.name == "nt" and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+# Watches directories for new .dat files and converts each one once it has
+# been completely written (its size and mtime unchanged for settle seconds,
+# and it ends with the closing MIME boundary - or has been unchanged for ten
+# times as long). Conversions run on a pool of jobs worker processes, with
+# at most maxQueued files waiting; further files are picked up as the queue
+# drains. Converted (and failed) files are recorded, with their size and
+# mtime, in stateFile so they are skipped after a restart unless they
+# change. stats() gives the queue depth and per-file latencies.
+class DatWatcher(object):
+
+    def __init__(self, directories, outputdir=None, formats=("tex",), maxHits=50, minProteinProb=0.05,
+                 includePepSummary=False, backend="auto", jobs=None, cache=None, shardSize=None,
+                 stateFile=None, settle=2.0, maxQueued=None, pollInterval=1.0, database=None, fdr=None):
+        import multiprocessing
+        self.directories  = list(directories)
+        self.outputdir    = outputdir
+        self.jobArgs      = (formats, maxHits, minProteinProb, includePepSummary, cache, shardSize, database,
+                             fdr)
+        self.backend      = backend
+        self.jobs         = jobs or multiprocessing.cpu_count()
+        self.maxQueued    = maxQueued if maxQueued is not None else 2*self.jobs
+        self.settle       = settle
+        self.pollInterval = pollInterval
+        self.stateFile    = stateFile or os.path.join(self.directories[0], ".mascotpy_watch.json")
+        if outputdir is not None and not os.path.isdir(outputdir):
+            os.makedirs(outputdir)
+        self.processed    = self._loadState()
+        # path -> (size, mtime, time first seen with that size and mtime)
+        self._seen    = {}
+        # path -> (AsyncResult, (size, mtime), time first seen, time queued)
+        self._pending = {}
+        self.latencies = collections.deque(maxlen=1000)
+        self.succeeded = 0
+        self.failed    = 0
+        self._pool = None
+
+    def _loadState(self):
+        import json
+        try:
+            with open(self.stateFile) as f:
+                return dict((path, tuple(stat)) for path, stat in json.load(f).items())
+        except (IOError, ValueError):
+            return {}
+
+    def _saveState(self):
+        import json
+        tmp = self.stateFile + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.processed, f)
+        replaceFile(tmp, self.stateFile)
+
+    # True if the file ends with a closing MIME boundary (--boundary--).
+    @staticmethod
+    def _complete(path, size):
+        with open(path, "rb") as f:
+            f.seek(max(size - 256, 0))
+            return f.read().rstrip().endswith("--")
+
+    # Files that are new (or changed) and have finished being written.
+    def _ready(self, now):
+        ready = []
+        for directory in self.directories:
+            for path in findDatFiles(directory):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                stat = (st.st_size, st.st_mtime)
+                if path in self._pending or self.processed.get(path) == stat:
+                    continue
+                seen = self._seen.get(path)
+                if seen is None or seen[:2] != stat:
+                    self._seen[path] = stat + (now,)
+                    continue
+                stable = now - seen[2]
+                if stable >= 10*self.settle or (stable >= self.settle and self._complete(path, st.st_size)):
+                    ready.append( (seen[2], path, stat) )
+        return [(path, stat, first) for first, path, stat in sorted(ready)]
+
+    # Scans the directories once, collects finished conversions and queues
+    # newly completed files.
+    def poll(self):
+        import multiprocessing
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.jobs, _initBatchWorker, (self.backend,))
+        now = time.time()
+        for path, (result, stat, first, queued) in self._pending.items():
+            if not result.ready():
+                continue
+            del self._pending[path]
+            inputfile, error, seconds, size = result.get()
+            latency = time.time() - first
+            self.latencies.append( (path, latency, seconds) )
+            if error is None:
+                self.succeeded += 1
+                print "ok     %6.2fs (latency %6.2fs)  %s" % (seconds, latency, path)
+            else:
+                self.failed += 1
+                print "FAILED %6.2fs (latency %6.2fs)  %s (%s)" % (seconds, latency, path, error)
+            self.processed[path] = stat
+            self._saveState()
+        for path, stat, first in self._ready(now):
+            if len(self._pending) >= self.maxQueued:
+                break
+            job = _batchJob(path, self.outputdir, *self.jobArgs)
+            self._pending[path] = (self._pool.apply_async(_batchWorker, (job,)), stat, first, now)
+            del self._seen[path]
+
+    def stats(self):
+        latencies = [latency for path, latency, seconds in self.latencies]
+        return {"queue_depth":   len(self._pending),
+                "waiting":       len(self._seen),
+                "succeeded":     self.succeeded,
+                "failed":        self.failed,
+                "mean_latency":  sum(latencies) / len(latencies) if latencies else None,
+                "max_latency":   max(latencies) if latencies else None,
+                "recent":        [{"file": path, "latency": latency, "seconds": seconds}
+                                  for path, latency, seconds in list(self.latencies)[-10:]]}
+
+    # Polls until interrupted (or for duration seconds), writing stats() as
+    # JSON to statsFile after every poll if given.
+    def run(self, duration=None, statsFile=None):
+        import json
+        start = time.time()
+        try:
+            while duration is None or time.time() - start < duration:
+                self.poll()
+                if statsFile is not None:
+                    with open(statsFile, "w") as f:
+                        json.dump(self.stats(), f, indent=1)
+                time.sleep(self.pollInterval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+
+
+
+
+
+# Metrics an abundance matrix can be built from: name -> (ProteinHit field,
+# csv format). The fields are msparser's getProteinEmPAI, getScore,
+# getNumPeptides and getCoverage.
+METRICS = {"empai":    ("empai",       "{0:.2f}"),
+           "score":    ("score",       "{0:.2f}"),
+           "peptides": ("numPeptides", "{0:.0f}"),
+           "coverage": ("coverage",    "{0:.0f}")}
+
+# Output formats of an abundance matrix.
+MATRIX_FORMATS = {"csv":     ".csv",
+                  "npz":     ".npz",
+                  "arrow":   ".arrow",
+                  "parquet": ".parquet"}
+
+
+# Extracts the protein summary of one run of a matrix (in a batch worker,
+# see _initBatchWorker). Returns (inputfile, error, accessions, descriptions,
+# values) with the metric values as an array of doubles. An emPAI the backend
+# could not compute (-1, see datparser) is NaN, as for a missing protein.
+def _matrixWorker(job):
+    import array
+    inputfile, field, maxHits, minProteinProb, cache, fdr = job
+    try:
+        data = loadResults(inputfile,maxHits,minProteinProb,False,_batchBackend,cache,fdr=fdr)
+        if not isinstance(data, Extraction):
+            return inputfile, "exit status %d" % data, None, None, None
+    except Exception as e:
+        return inputfile, "%s: %s" % (type(e).__name__, e), None, None, None
+    values = array.array("d", [getattr(prot, field) for prot in data.proteins])
+    if field == "empai":
+        nan = float("nan")
+        values = array.array("d", [nan if v < 0 else v for v in values])
+    return (inputfile, None,
+            [prot.accession for prot in data.proteins],
+            [prot.description for prot in data.proteins],
+            values)
+
+
+# Builds an accession x run matrix of metric (see METRICS) over inputfiles,
+# extracting the runs across a pool of jobs worker processes. Accessions are
+# given rows in the order they are first seen (by a dictionary index), each
+# run is an array of doubles with NaN where the run did not report the
+# protein. Returns (columns, failed): columns as columnarTables gives them,
+# accession and description followed by a column per run (named after the
+# file), and failed maps inputfiles that could not be read to why. fdr, if
+# given, drops each run's hits below the score passing that false discovery
+# rate before the metric is taken.
+def abundanceMatrix(inputfiles,metric="empai",maxHits=50,minProteinProb=0.05,backend="auto",
+                    jobs=None,cache=None,fdr=None):
+    import array, multiprocessing
+    field = METRICS[metric][0]
+    inputfiles = list(inputfiles)
+    names = [os.path.splitext(os.path.basename(f))[0] for f in inputfiles]
+    if len(set(names)) < len(names):
+        names = inputfiles
+
+    index = {}
+    accessions, descriptions = [], []
+    runs = []
+    failed = {}
+    missing = array.array("d", [float("nan")])
+    work = [(inputfile, field, maxHits, minProteinProb, cache, fdr) for inputfile in inputfiles]
+    pool = multiprocessing.Pool(jobs, _initBatchWorker, (backend,))
+    try:
+        for name, (inputfile, error, accs, descs, values) in zip(names, pool.imap(_matrixWorker, work)):
+            if error is not None:
+                failed[inputfile] = error
+                print "FAILED %s (%s)" % (inputfile, error)
+                continue
+            column = missing * len(index)
+            for acc, desc, value in zip(accs, descs, values):
+                row = index.get(acc)
+                if row is None:
+                    row = index[acc] = len(accessions)
+                    accessions.append(acc)
+                    descriptions.append(desc)
+                    column.append(value)
+                else:
+                    column[row] = value
+            runs.append( (name, column) )
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    columns = [("accession", "str", accessions), ("description", "str", descriptions)]
+    for name, column in runs:
+        column.extend(missing * (len(accessions) - len(column)))
+        columns.append( (name, "float", column) )
+    return columns, failed
+
+
+# Writes an abundance matrix (see abundanceMatrix) as fmt, one of
+# MATRIX_FORMATS. Missing values are left empty in csv, NaN otherwise.
+def writeMatrix(columns,outputfile,fmt="csv",metric="empai",compressLevel=None):
+    if fmt == "csv":
+        import csv
+        formatValue = METRICS[metric][1].format
+        with openSink(outputfile,compressLevel) as ofile:
+            writer = csv.writer(ofile)
+            writer.writerow([name for name, kind, values in columns])
+            for row in zip(*[values for name, kind, values in columns]):
+                writer.writerow(row[:2] + tuple("" if v != v else formatValue(v) for v in row[2:]))
+    elif fmt == "npz":
+        import zipfile
+        with zipfile.ZipFile(outputfile, "w", zipfile.ZIP_STORED, allowZip64=True) as npz:
+            for name, kind, values in columns:
+                npz.writestr(name + ".npy", npyBytes(kind, values))
+    elif fmt == "arrow":
+        import pyarrow
+        table = _arrowTable(columns)
+        writer = pyarrow.RecordBatchFileWriter(outputfile, table.schema)
+        writer.write_table(table)
+        writer.close()
+    elif fmt == "parquet":
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(_arrowTable(columns), outputfile)
+    else:
+        raise ValueError("unknown matrix format '%s', expected one of %s"
+                         % (fmt, ", ".join(sorted(MATRIX_FORMATS))))
+
+
+# Builds the abundance matrix of metric over the .dat files matched by
+# pattern (a directory or glob) and writes it to outputfile as fmt. Returns
+# an exit status.
+def datMatrix(pattern,outputfile,metric="empai",fmt="csv",maxHits=50,minProteinProb=0.05,backend="auto",
+              jobs=None,cache=None,compressLevel=None,fdr=None):
+    inputfiles = findDatFiles(pattern)
+    if not inputfiles:
+        print "No .dat files found matching", pattern
+        return 2
+    start = time.time()
+    columns, failed = abundanceMatrix(inputfiles,metric,maxHits,minProteinProb,backend,jobs,cache,fdr)
+    try:
+        writeMatrix(columns,outputfile,fmt,metric,compressLevel)
+    except ImportError as e:
+        print "Cannot write %s output: %s" % (fmt, e)
+        return 2
+    print "%d proteins x %d runs (%d failed) in %.2fs written to %s" \
+          % (len(columns[0][2]), len(columns) - 2, len(failed), time.time() - start, outputfile)
+    return 2 if failed else 0
+
+
+
+
+
+
+# Parses a sweep of values: a comma separated list of values and/or
+# inclusive start:stop:step ranges, e.g. "0.01,0.05:0.2:0.05". Values are
+# converted with kind (int or float).
+def parseSweep(text,kind=float):
+    values = []
+    for item in text.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if ":" in item:
+            parts = [kind(v) for v in item.split(":")]
+            if len(parts) != 3 or parts[2] <= 0:
+                raise ValueError("invalid range '%s', expected start:stop:step" % item)
+            start, stop, step = parts
+            n = int(round((stop - start) / float(step))) if kind is float else (stop - start) // step
+            values.extend(kind(round(start + i*step, 10)) for i in range(n+1))
+        else:
+            values.append(kind(item))
+    return values
+
+
+# Settings of one sweep point, and what it found. distinct counts peptide
+# matches of distinct queries.
+SweepPoint = collections.namedtuple("SweepPoint",
+    "minProteinProb maxHits minIonsScore minPepLen proteins peptides distinct seconds")
+
+# (proteins, peptides, distinct) of results, as SweepPoint counts them,
+# without extracting the hits.
+def _countHits(results):
+    proteins = peptides = 0
+    queries = set()
+    prot = results.getHit(1)
+    while prot:
+        proteins += 1
+        for i in range(1, 1+prot.getNumPeptides()):
+            q = prot.getPeptideQuery(i)
+            p = prot.getPeptideP(i)
+            if p == -1 or q == -1 or not results.getPeptide(q, p):
+                continue
+            peptides += 1
+            queries.add(q)
+        prot = results.getHit(proteins+1)
+    return proteins, peptides, len(queries)
+
+
+# The resfile shared by sweep workers (forked from the process that opened
+# it), so they do not reopen the file.
+_sweepResfile = None
+
+
+# Builds the summary for one sweep setting from _sweepResfile, writing the
+# full outputs (name -> (writer, path)) if any. Returns a SweepPoint, or
+# the setting and the error if it failed.
+def _sweepWorker(job):
+    (maxHits, minProteinProb, minIonsScore, minPepLen), outputs, includePepSummary, compressLevel = job
+    start = time.time()
+    try:
+        lib, resfile, params = _sweepResfile
+        results = buildSummary(lib, resfile, maxHits, minProteinProb, minIonsScore, minPepLen)
+        if outputs:
+            data = extractResults(lib, params, results, minProteinProb, True)
+            for writer, path in outputs:
+                writer(data, path, includePepSummary, compressLevel)
+            counts = (len(data.proteins), sum(len(peps) for peps in data.peptides),
+                      len(set(pep.query for peps in data.peptides for pep in peps)))
+        else:
+            counts = _countHits(results)
+    except Exception as e:
+        return job[0], "%s: %s" % (type(e).__name__, e)
+    return SweepPoint(minProteinProb, maxHits, minIonsScore, minPepLen, *(counts + (time.time() - start,)))
+
+
+# Opens inputfile once and builds its peptide summary for every combination
+# of the given maxHits, minProteinProb, minIonsScore and minPepLen values,
+# returning a [SweepPoint] per combination (in order). With jobs > 1 the
+# summaries are built by that many forked processes sharing the open
+# resfile; msparser's resfile cannot be shared this way, and without fork
+# (Windows) there is no sharing, so those sweeps always run in this
+# process. If formats are given, each setting's full outputs are written to
+# <outputbase>_p<prob>_n<hits>_s<score>_l<length><ext>.
+def sweepResults(inputfile,maxHits=(50,),minProteinProb=(0.05,),minIonsScore=(0,),minPepLen=(0,),
+                 backend="auto",jobs=1,formats=(),outputbase=None,includePepSummary=False,compressLevel=None):
+    import itertools, multiprocessing
+    global _sweepResfile
+    lib = getBackend(backend)
+    opened = openResfile(lib, inputfile)
+    if opened is None:
+        return None
+    if outputbase is None:
+        outputbase = os.path.splitext(inputfile)[0]
+
+    work = []
+    for setting in itertools.product(maxHits, minProteinProb, minIonsScore, minPepLen):
+        tag = "_p%g_n%d_s%g_l%d" % (setting[1], setting[0], setting[2], setting[3])
+        outputs = [(FORMATS[fmt][0], outputbase + tag + FORMATS[fmt][1]) for fmt in formats]
+        work.append( (setting, outputs, includePepSummary, compressLevel) )
+
+    _sweepResfile = (lib,) + opened
+    try:
+        # Workers see the open resfile only if they are forked from here.
+        if jobs <= 1 or len(work) < 2 or lib.__name__ != datparser.__name__ or not hasattr(os, "fork"):
+            points = map(_sweepWorker, work)
+        else:
+            # The first setting is built here, so the sections it parses
+            # are shared with (rather than parsed again by) the workers.
+            points = [_sweepWorker(work[0])]
+            pool = multiprocessing.Pool(jobs, _initBatchWorker, (backend,))
+            try:
+                points.extend(pool.map(_sweepWorker, work[1:]))
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+    finally:
+        _sweepResfile = None
+    return points
+
+
+# Runs a sweep (see sweepResults) and writes its table of protein and
+# peptide counts per setting to tablefile as csv, and to stdout. Returns an
+# exit status.
+def datSweep(inputfile,tablefile,maxHits=(50,),minProteinProb=(0.05,),minIonsScore=(0,),minPepLen=(0,),
+             backend="auto",jobs=1,formats=(),includePepSummary=False,compressLevel=None):
+    import csv
+    try:
+        points = sweepResults(inputfile,maxHits,minProteinProb,minIonsScore,minPepLen,backend,jobs,
+                              formats,None,includePepSummary,compressLevel)
+    except (ImportError, ValueError) as e:
+        print e
+        return 2
+    if points is None:
+        return 2
+    failed = [point for point in points if not isinstance(point, SweepPoint)]
+    points = [point for point in points if isinstance(point, SweepPoint)]
+    with openSink(tablefile,compressLevel) as ofile:
+        writer = csv.writer(ofile)
+        writer.writerow(SweepPoint._fields)
+        writer.writerows(points)
+    print "%8s %6s %6s %6s %9s %9s %9s" % ("minProb", "maxHit", "minScr", "minLen", "proteins", "peptides",
+                                           "distinct")
+    for point in points:
+        print "%8g %6d %6g %6d %9d %9d %9d" % point[:7]
+    for setting, error in failed:
+        print "FAILED maxHits=%d minProteinProb=%g minIonsScore=%g minPepLen=%d (%s)" % (setting + (error,))
+    return 2 if failed else 0
+
+
+
+
+
+
+# Prints the spectrum and ranked peptide matches of each of queries, and
+# the peptide matches of each of accessions, in inputfile. They are read
+# through its offset index (see datparser.DatIndex, saved in indexfile,
+# default <inputfile>.idx), which is built on first use. Returns an exit
+# status.
+def datLookup(inputfile,queries=(),accessions=(),indexfile=None,maxPeaks=10):
+    try:
+        index = datparser.DatIndex.open(inputfile, indexfile)
+    except (IOError, OSError) as e:
+        print "Cannot index file '%s': %s" % (inputfile, e)
+        return 2
+    status = 0
+    try:
+        for q in queries:
+            found = index.query(q)
+            if found is None:
+                print "Query %d: not in %s (%d queries)" % (q, inputfile, index.getNumQueries())
+                status = 2
+                continue
+            print "Query %d: %s (charge %s, %d peaks)" % (q, found["title"], found["charge"], len(found["peaks"]))
+            for key in sorted(found["summary"]):
+                print "  %-16s %s" % (key, found["summary"][key])
+            peaks = sorted(found["peaks"], key=lambda peak: -peak[1])[:maxPeaks]
+            print "  most intense peaks:", ", ".join("%.4f:%.1f" % peak for peak in peaks)
+            print "  %4s %7s  %-30s %s" % ("rank", "score", "peptide", "proteins")
+            for pep in found["matches"]:
+                print "  %4d %7.2f  %-30s %s" % (pep.rank, pep.ionsScore, pep.peptideStr,
+                                                 " ".join(prot[0] for prot in pep.proteins))
+            print
+        for accession in accessions:
+            mass, description = index.proteinInfo(accession)
+            matches = index.protein(accession)
+            if not matches:
+                print "Protein %s: no peptide matches in %s" % (accession, inputfile)
+                status = 2
+                continue
+            print "Protein %s: %s (%.2f kDa, %d matches)" % (accession, description, mass/1000, len(matches))
+            print "  %6s %4s %7s  %-30s %s" % ("query", "rank", "score", "peptide", "position")
+            for pep in matches:
+                start, end = [(s, e) for acc, s, e in pep.proteins if acc == accession][0]
+                print "  %6d %4d %7.2f  %-30s %d-%d" % (pep.query, pep.rank, pep.ionsScore, pep.peptideStr,
+                                                        start, end)
+            print
+    finally:
+        index.close()
+    return status
 
 
 
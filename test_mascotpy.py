@@ -0,0 +1,166 @@
+##############################################################################
+# Tests of mascotpy on small synthetic .dat files (see benchmark.py), run   #
+# with:                                                                      #
+#   python -m unittest test_mascotpy                                         #
+# The tex and csv reports are compared against the expected files in        #
+# testdata/, written by an earlier run of the native backend. After an       #
+# intended change to the reports, regenerate them with:                      #
+#   python test_mascotpy.py --regenerate                                     #
+##############################################################################
+
+import os, random, shutil, sys, tempfile, unittest
+
+import benchmark, datparser, mascotpy
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testdata")
+
+# Settings of the synthetic file the expected reports were written from.
+SYNTHETIC = {"queries": 200, "proteins": 20, "pepsPerProtein": 4, "descLength": 60,
+             "peaks": 5, "seed": 7, "decoys": True}
+
+
+# Writes the synthetic .dat file to directory, returns its path.
+def writeSynthetic(directory):
+    path = os.path.join(directory, "synthetic.dat")
+    benchmark.writeSyntheticDat(path, **SYNTHETIC)
+    return path
+
+
+# Converts inputfile (with the peptide summary, native backend) to
+# <outputbase>.tex and <outputbase>.csv.
+def writeReports(inputfile, outputbase):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        status = mascotpy.datConvert(inputfile, outputbase, 50, 0.05, True, "native", ("tex", "csv"))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    if status:
+        raise RuntimeError("datConvert exited with status %d" % status)
+
+
+class QValuesTest(unittest.TestCase):
+
+    # Worked by hand: ranked 50T 40T 40T 40D 30T 20D, the tied 40s all take
+    # the FDR at the last of them (1 decoy / 3 targets).
+    def testTiedScoresPython(self):
+        targets, decoys, threshold = mascotpy._qValuesPython([50, 40, 40, 30], [40, 20], 0.01)
+        self.assertEqual(targets, [0.0, 0.25, 0.25, 0.25])
+        self.assertEqual(decoys, [0.25, 0.5])
+        self.assertEqual(threshold, 50)
+        self.assertEqual(mascotpy._qValuesPython([50, 40, 40, 30], [40, 20], 0.3)[2], 30)
+        self.assertEqual(mascotpy._qValuesPython([10], [20], 0.01)[2], None)
+
+    def testNumpyMatchesPython(self):
+        try:
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest("numpy is not installed")
+        rng = random.Random(3)
+        # Whole number scores, so that many are tied across and within the
+        # targets and decoys.
+        for n in (1, 10, 500):
+            targets = [rng.randint(0, 40) for _ in range(n)]
+            decoys  = [rng.randint(0, 30) for _ in range(n//2 + 1)]
+            for fdr in (0.01, 0.1, 0.5):
+                expected = mascotpy._qValuesPython(targets, decoys, fdr)
+                actual   = mascotpy.qValues(targets, decoys, fdr)
+                self.assertEqual(list(actual[0]), expected[0])
+                self.assertEqual(list(actual[1]), expected[1])
+                self.assertEqual(actual[2], expected[2])
+
+
+class PeptideIndexTest(unittest.TestCase):
+
+    def testSharedAndUnique(self):
+        index = mascotpy.PeptideIndex()
+        a = index.addHit("A")
+        index.add(a, 1, 1, "PEPA")
+        index.add(a, 2, 1, "PEPB")
+        # Adding a match to the same hit twice counts it once.
+        index.add(a, 2, 1, "PEPB")
+        b = index.addHit("B")
+        index.add(b, 2, 1, "PEPB")
+        index.add(b, 3, 1, "PEPC")
+        c = index.addHit("C")
+        index.add(c, 2, 1, "PEPB")
+        self.assertTrue(index.isUnique(1, 1))
+        self.assertTrue(index.isUnique(3, 1))
+        self.assertFalse(index.isUnique(2, 1))
+        self.assertEqual(index.numShared(1, 1), 0)
+        self.assertEqual(index.numShared(2, 1), 2)
+        self.assertEqual(index.numShared(9, 1), 0)
+        self.assertEqual(index.sharedWith(a, 2, 1), ["B", "C"])
+        self.assertEqual(index.hitsOfPeptide("PEPB"), [a, b, c])
+
+    # The index built from the results (indexPeptides) agrees with one
+    # built from the extracted hits.
+    def testSynthetic(self):
+        directory = tempfile.mkdtemp()
+        try:
+            data = mascotpy.loadResults(writeSynthetic(directory), 50, 0.05, True, "native")
+            hits = list(data.hits())
+            fromHits = mascotpy.PeptideIndex.fromHits(hits)
+            index = data.peptideIndex()
+            shared = 0
+            for prot, peptides in hits:
+                for pep in peptides:
+                    self.assertEqual(index.numShared(pep.query, pep.rank),
+                                     fromHits.numShared(pep.query, pep.rank))
+                    shared += not index.isUnique(pep.query, pep.rank)
+            # The synthetic file shares some peptides between proteins.
+            self.assertTrue(shared)
+        finally:
+            shutil.rmtree(directory)
+
+
+class ParseSweepTest(unittest.TestCase):
+
+    def testValuesAndRanges(self):
+        self.assertEqual(mascotpy.parseSweep("0.01,0.05:0.2:0.05"), [0.01, 0.05, 0.1, 0.15, 0.2])
+        self.assertEqual(mascotpy.parseSweep("0.1:0.3:0.1"), [0.1, 0.2, 0.3])
+        self.assertEqual(mascotpy.parseSweep("10:50:20", int), [10, 30, 50])
+        self.assertEqual(mascotpy.parseSweep("10:40:20,5", int), [10, 30, 5])
+        self.assertEqual(mascotpy.parseSweep(" 3, ,4 ", int), [3, 4])
+
+    def testInvalidRanges(self):
+        for text in ("1:2", "1:2:0", "1:2:-1", "1:2:3:4"):
+            self.assertRaises(ValueError, mascotpy.parseSweep, text)
+
+
+class ReportTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.outputbase = os.path.join(cls.directory, "synthetic")
+        writeReports(writeSynthetic(cls.directory), cls.outputbase)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def assertSameAsExpected(self, ext):
+        with open(os.path.join(TESTDATA, "synthetic" + ext), "rb") as f:
+            expected = f.read()
+        with open(self.outputbase + ext, "rb") as f:
+            actual = f.read()
+        self.assertEqual(actual.splitlines(), expected.splitlines())
+
+    def testTex(self):
+        self.assertSameAsExpected(".tex")
+
+    def testCsv(self):
+        self.assertSameAsExpected(".csv")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--regenerate"]:
+        directory = tempfile.mkdtemp()
+        try:
+            writeReports(writeSynthetic(directory), os.path.join(TESTDATA, "synthetic"))
+        finally:
+            shutil.rmtree(directory)
+    else:
+        unittest.main()